@@ -2,9 +2,7 @@ import backtrader as bt
 import backtrader.feeds as btfeeds
 
 from pathlib import Path
-import matplotlib
 
-matplotlib.use('Agg')
 data_path = Path('.') / 'data'
 
 
@@ -122,6 +120,11 @@ class TestStrategy(bt.Strategy):
 
 
 if __name__ == '__main__':
+    # backtrader only imports matplotlib when plotting, the backend is
+    # configured here so that importing the strategy stays headless
+    import matplotlib
+    matplotlib.use('Agg')
+
     # Create a cerebro entity
     cerebro = bt.Cerebro()
 
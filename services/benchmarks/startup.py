@@ -0,0 +1,140 @@
+import ast
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+# Cold import benchmark for the headless core.
+#
+# Each measure runs in a fresh interpreter with `-X importtime`, so nothing
+# is cached in `sys.modules`. The budget guards the time the core adds on top
+# of NumPy / pandas, which every process needs anyway, and checks that no
+# plotting or backtrader module is pulled in at import.
+#
+#   python -m services.benchmarks.startup
+
+project_root = Path(__file__).resolve().parents[2]
+
+core_modules = [
+    'services.profiling.profiler',
+    'services.hist_data.history',
+    'services.hist_data.compact',
+    'services.hist_data.registry',
+    'services.strategies.strategies',
+    'services.strategies.execution',
+    'services.strategies.kernels',
+    'services.strategies.robustness',
+    'services.strategies.sizing',
+]
+
+baseline_modules = [
+    'numpy',
+    'pandas',
+]
+
+forbidden_modules = [
+    'matplotlib',
+    'backtrader',
+    'bokeh',
+    'holoviews',
+]
+
+# seconds added by the core on top of the baseline modules
+default_budget = float(os.environ.get('PYFI_IMPORT_BUDGET', 0.15))
+
+
+def _import_statement(modules):
+    return('; '.join(f'import {module}' for module in modules))
+
+
+def cold_import(modules, forbidden=()):
+    # returns the total import time in seconds as reported by -X importtime
+    # and the forbidden modules found in sys.modules after the imports
+    code = (
+        _import_statement(modules) + '\n'
+        'import sys\n'
+        f'print([m for m in {list(forbidden)!r} if m in sys.modules])\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=project_root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        # only top level imports, nested ones are in their parent cumulative
+        if fields[2].startswith('  '):
+            continue
+        try:
+            total_us += int(fields[1])
+        except ValueError:
+            # header line
+            continue
+    loaded = ast.literal_eval(result.stdout.strip().splitlines()[-1])
+    return(total_us / 1e6, loaded)
+
+
+def measure_startup(
+    modules=None,
+    baseline=None,
+    repeat=5,
+):
+    if modules is None:
+        modules = core_modules
+    if baseline is None:
+        baseline = baseline_modules
+    baseline_times = []
+    core_times = []
+    loaded = set()
+    for _ in range(repeat):
+        baseline_times.append(cold_import(baseline)[0])
+        core_time, core_loaded = cold_import(
+            baseline + modules,
+            forbidden=forbidden_modules,
+        )
+        core_times.append(core_time)
+        loaded.update(core_loaded)
+    baseline_time = statistics.median(baseline_times)
+    core_time = statistics.median(core_times)
+    return({
+        'baseline_s': baseline_time,
+        'total_s': core_time,
+        'overhead_s': core_time - baseline_time,
+        'forbidden_loaded': sorted(loaded),
+    })
+
+
+def check_startup_budget(
+    budget=default_budget,
+    repeat=5,
+):
+    results = measure_startup(repeat=repeat)
+    if results['forbidden_loaded']:
+        raise RuntimeError(
+            'Heavy modules imported by the core: '
+            + ', '.join(results['forbidden_loaded'])
+        )
+    if results['overhead_s'] > budget:
+        raise RuntimeError(
+            f"Core import takes {results['overhead_s']:.3f}s on top of "
+            f"{', '.join(baseline_modules)}, budget is {budget:.3f}s"
+        )
+    return(results)
+
+
+if __name__ == '__main__':
+    try:
+        results = check_startup_budget()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    print(f"Baseline import: {results['baseline_s']:.3f}s")
+    print(f"Core import: {results['total_s']:.3f}s")
+    print(f"Core overhead: {results['overhead_s']:.3f}s")
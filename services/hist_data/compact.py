@@ -0,0 +1,370 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from services.hist_data.history import get_ohlc
+from services.profiling.profiler import profiled
+
+
+# Compact OHLC representation on a regular bar grid.
+#
+# Bar `i` covers [start + i * freq, start + (i + 1) * freq[ (epoch seconds).
+# Bars without trades are kept and flagged in a packed validity bitmask
+# instead of being dropped, so that rolling windows always span the same
+# duration and aligning pairs is integer arithmetic on bar offsets. Prices
+# and volumes are stored as float32 (about 7 significant digits) and trade
+# counts as int32, which is less than half the memory of the float64
+# DataFrame returned by `get_ohlc`.
+#
+# Raw values of missing bars are meaningless; filling is applied lazily when
+# a column is read, according to a fill policy mapping each field to:
+#   'ffill': last valid close (bars before the first valid one are NaN)
+#   'zero': 0
+#   'nan': NaN (0 for integer columns)
+
+price_fields = ('open', 'high', 'low', 'close')
+fields = price_fields + ('volume', 'trade_count')
+
+default_fill_policy = {
+    'open': 'ffill',
+    'high': 'ffill',
+    'low': 'ffill',
+    'close': 'ffill',
+    'volume': 'zero',
+    'trade_count': 'zero',
+}
+
+
+class CompactOHLC(object):
+    # OHLC bars of one pair on a regular grid with a validity bitmask
+    def __init__(
+        self,
+        start,
+        freq,
+        columns,
+        valid_bits,
+        n_bars,
+        fill_policy=None,
+    ) -> None:
+        self.start = int(start)
+        self.freq = int(freq)
+        self.n_bars = int(n_bars)
+        self.columns = columns
+        self.valid_bits = valid_bits
+        self.fill_policy = dict(default_fill_policy)
+        if fill_policy:
+            self.fill_policy.update(fill_policy)
+
+    @classmethod
+    def empty(cls, start, freq, n_bars, dtype=np.float32, fill_policy=None):
+        columns = {
+            field: np.zeros(n_bars, dtype=dtype) for field in price_fields
+        }
+        columns['volume'] = np.zeros(n_bars, dtype=dtype)
+        columns['trade_count'] = np.zeros(n_bars, dtype=np.int32)
+        return(
+            cls(
+                start=start,
+                freq=freq,
+                columns=columns,
+                valid_bits=np.zeros((n_bars + 7) // 8, dtype=np.uint8),
+                n_bars=n_bars,
+                fill_policy=fill_policy,
+            )
+        )
+
+    @classmethod
+    def _from_bars(cls, bars, freq, start, values, dtype, fill_policy):
+        # `bars` are bar offsets from `start`, `values` a dict of arrays
+        n_bars = int(bars.max()) + 1 if len(bars) else 0
+        ohlc = cls.empty(
+            start,
+            freq,
+            n_bars,
+            dtype=dtype,
+            fill_policy=fill_policy,
+        )
+        for field, array in values.items():
+            ohlc.columns[field][bars] = array
+        valid = np.zeros(n_bars, dtype=bool)
+        valid[bars] = True
+        ohlc.valid_bits = np.packbits(valid, bitorder='little')
+        return(ohlc)
+
+    @classmethod
+    @profiled
+    def from_frame(
+        cls,
+        ohlc,
+        freq,
+        dtype=np.float32,
+        fill_policy=None,
+    ):
+        # builds from a DataFrame with a `timestamp` column, as returned by
+        # `get_ohlc` (possibly with bars missing)
+        timestamps = ohlc['timestamp'].to_numpy(dtype=np.int64)
+        if len(timestamps) == 0:
+            return(cls.empty(0, freq, 0, dtype=dtype, fill_policy=fill_policy))
+        start = timestamps.min() // freq * freq
+        bars = (timestamps - start) // freq
+        return(
+            cls._from_bars(
+                bars,
+                freq,
+                start,
+                {field: ohlc[field].to_numpy() for field in fields},
+                dtype,
+                fill_policy,
+            )
+        )
+
+    @classmethod
+    @profiled
+    def from_trades(
+        cls,
+        trades,
+        freq,
+        dtype=np.float32,
+        fill_policy=None,
+    ):
+        # resamples a trades DataFrame (as returned by `get_trades`) without
+        # going through pandas resample
+        timestamps = trades['timestamp'].to_numpy(dtype=np.float64)
+        prices = trades['price'].to_numpy(dtype=np.float64)
+        volumes = trades['volume'].to_numpy(dtype=np.float64)
+        if len(timestamps) == 0:
+            return(cls.empty(0, freq, 0, dtype=dtype, fill_policy=fill_policy))
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, prices, volumes = (
+            timestamps[order], prices[order], volumes[order]
+        )
+        start = int(timestamps[0]) // freq * freq
+        trade_bars = ((timestamps - start) // freq).astype(np.int64)
+        bars, firsts = np.unique(trade_bars, return_index=True)
+        lasts = np.append(firsts[1:], len(trade_bars)) - 1
+        return(
+            cls._from_bars(
+                bars,
+                freq,
+                start,
+                {
+                    'open': prices[firsts],
+                    'high': np.maximum.reduceat(prices, firsts),
+                    'low': np.minimum.reduceat(prices, firsts),
+                    'close': prices[lasts],
+                    'volume': np.add.reduceat(volumes, firsts),
+                    'trade_count': lasts - firsts + 1,
+                },
+                dtype,
+                fill_policy,
+            )
+        )
+
+    @property
+    def valid(self):
+        return(
+            np.unpackbits(
+                self.valid_bits,
+                count=self.n_bars,
+                bitorder='little',
+            ).astype(bool)
+        )
+
+    @property
+    def end(self):
+        # timestamp of the end of the last bar (excluded)
+        return(self.start + self.n_bars * self.freq)
+
+    @property
+    def timestamps(self):
+        return(self.start + np.arange(self.n_bars, dtype=np.int64) * self.freq)
+
+    @property
+    def nbytes(self):
+        return(
+            sum(array.nbytes for array in self.columns.values())
+            + self.valid_bits.nbytes
+        )
+
+    def bar_index(self, timestamp):
+        # index of the bar containing `timestamp`, may be out of range
+        timestamp = np.asarray(timestamp, dtype=np.int64)
+        return((timestamp - self.start) // self.freq)
+
+    def column(self, field, policy=None):
+        # read-only array, a view on the storage when every bar is valid and
+        # a filled copy otherwise
+        if policy is None:
+            policy = self.fill_policy[field]
+        values = self.columns[field]
+        valid = self.valid
+        if valid.all():
+            column = values.view()
+        elif policy == 'zero':
+            column = np.where(valid, values, 0).astype(values.dtype)
+        elif policy == 'nan':
+            if values.dtype.kind != 'f':
+                column = np.where(valid, values, 0).astype(values.dtype)
+            else:
+                column = np.where(valid, values, np.nan).astype(values.dtype)
+        elif policy == 'ffill':
+            # a missing bar takes the last valid close, for every field
+            positions = np.where(valid, np.arange(self.n_bars), -1)
+            np.maximum.accumulate(positions, out=positions)
+            filled = np.where(
+                positions >= 0,
+                self.columns['close'][np.maximum(positions, 0)],
+                np.nan,
+            )
+            column = np.where(valid, values, filled).astype(values.dtype)
+        else:
+            raise ValueError(f'Unexpected fill policy: {policy}')
+        column.flags.writeable = False
+        return(column)
+
+    def __getattr__(self, name):
+        if name in fields:
+            return(self.column(name))
+        raise AttributeError(name)
+
+    def __len__(self):
+        return(self.n_bars)
+
+    def slice(self, start=None, end=None):
+        # view on the bars overlapping [start, end[ (timestamps), no copy
+        # except for the bitmask when `start` is not on a byte boundary
+        first = 0 if start is None else int(
+            np.clip(self.bar_index(start), 0, self.n_bars)
+        )
+        last = self.n_bars if end is None else int(
+            np.clip(-((self.start - end) // self.freq), first, self.n_bars)
+        )
+        if first % 8 == 0:
+            valid_bits = self.valid_bits[first // 8:(last + 7) // 8]
+        else:
+            valid_bits = np.packbits(self.valid[first:last], bitorder='little')
+        return(
+            CompactOHLC(
+                start=self.start + first * self.freq,
+                freq=self.freq,
+                columns={
+                    field: array[first:last]
+                    for field, array in self.columns.items()
+                },
+                valid_bits=valid_bits,
+                n_bars=last - first,
+                fill_policy=self.fill_policy,
+            )
+        )
+
+    def to_frame(self, policy=None, compute_datetime=True):
+        frame = pd.DataFrame(
+            {'timestamp': self.timestamps},
+        )
+        for field in fields:
+            frame[field] = np.array(self.column(
+                field,
+                policy=None if policy is None else policy.get(field),
+            ))
+        frame['valid'] = self.valid
+        if compute_datetime:
+            frame['datetime'] = [
+                dt.datetime.fromtimestamp(y) for y in frame['timestamp']
+            ]
+        return(frame)
+
+    def __repr__(self):
+        return(
+            f'CompactOHLC(start={self.start}, freq={self.freq}, '
+            f'n_bars={self.n_bars}, valid={int(self.valid.sum())})'
+        )
+
+
+def align(
+    ohlcs,
+    field='close',
+    how='inner',
+    policy=None,
+):
+    # aligns several CompactOHLC sharing the same frequency and bar grid.
+    # Returns (start, matrix, valid) where matrix is (bars, pairs) and valid
+    # flags bars which had trades. `how` is 'inner' (common range) or
+    # 'outer' (whole range, bars outside a pair history are NaN / invalid).
+    freqs = {ohlc.freq for ohlc in ohlcs}
+    if len(freqs) != 1:
+        raise ValueError(f'Cannot align different frequencies: {freqs}')
+    freq = freqs.pop()
+    if len({ohlc.start % freq for ohlc in ohlcs}) != 1:
+        raise ValueError('Cannot align bars which are not on the same grid')
+    if how == 'inner':
+        start = max(ohlc.start for ohlc in ohlcs)
+        end = min(ohlc.end for ohlc in ohlcs)
+    elif how == 'outer':
+        start = min(ohlc.start for ohlc in ohlcs)
+        end = max(ohlc.end for ohlc in ohlcs)
+    else:
+        raise ValueError(f'Unexpected alignment: {how}')
+    n_bars = max((end - start) // freq, 0)
+    dtype = np.result_type(*(ohlc.columns[field].dtype for ohlc in ohlcs))
+    matrix = np.full(
+        (n_bars, len(ohlcs)),
+        np.nan if dtype.kind == 'f' else 0,
+        dtype=dtype,
+    )
+    valid = np.zeros((n_bars, len(ohlcs)), dtype=bool)
+    for k, ohlc in enumerate(ohlcs):
+        offset = (ohlc.start - start) // freq
+        first = max(offset, 0)
+        last = min(offset + ohlc.n_bars, n_bars)
+        if last <= first:
+            continue
+        source = slice(first - offset, last - offset)
+        matrix[first:last, k] = ohlc.column(field, policy=policy)[source]
+        valid[first:last, k] = ohlc.valid[source]
+    return(start, matrix, valid)
+
+
+def price_history(
+    ohlcs,
+    field='close',
+    how='inner',
+    policy=None,
+):
+    # price history DataFrame, one column per pair on the regular bar grid,
+    # in the layout expected by the strategies. `ohlcs` maps column names to
+    # CompactOHLC.
+    names = list(ohlcs.keys())
+    start, matrix, _ = align(
+        list(ohlcs.values()),
+        field=field,
+        how=how,
+        policy=policy,
+    )
+    freq = next(iter(ohlcs.values())).freq
+    timestamps = start + np.arange(len(matrix), dtype=np.int64) * freq
+    return(
+        pd.DataFrame(
+            matrix,
+            columns=names,
+            index=pd.Index(
+                [dt.datetime.fromtimestamp(y) for y in timestamps],
+                name='datetime',
+            ),
+        )
+    )
+
+
+def get_compact_ohlc(
+    pair,
+    int_freq=60,
+    dtype=np.float32,
+    fill_policy=None,
+):
+    return(
+        CompactOHLC.from_frame(
+            get_ohlc(pair, int_freq=int_freq, compute_datetime=False),
+            int_freq,
+            dtype=dtype,
+            fill_policy=fill_policy,
+        )
+    )
@@ -4,6 +4,8 @@ import datetime as dt
 import os
 import re
 
+from services.profiling.profiler import profiled
+
 
 data_path = Path('.') / 'data'
 
@@ -29,6 +31,7 @@ def rename_ohlc_files():
         )
 
 
+@profiled
 def get_trades(
     pair,
     data_path=data_path / 'trades'
@@ -52,6 +55,7 @@ def get_trades(
     return(trades)
 
 
+@profiled
 def ohlc_from_trades(
     trades,
     freq='10s',
@@ -104,7 +108,8 @@ def kraken_formatted_ohlc_from_trades(trades, freq='10s'):
     )
 
 
-def get_ohlc(pair, int_freq=60, compute_datetime=True):
+@profiled
+def get_ohlc(pair, int_freq=60, compute_datetime=True, data_path=data_path):
     try:
         ohlc = (
             pd.read_csv(
@@ -122,7 +127,7 @@ def get_ohlc(pair, int_freq=60, compute_datetime=True):
         )
     except FileNotFoundError:
         ohlc = kraken_formatted_ohlc_from_trades(
-            get_trades(pair),
+            get_trades(pair, data_path=data_path / 'trades'),
             freq=f'{int_freq}s'
         )
         ohlc.to_csv(
@@ -0,0 +1,302 @@
+import csv
+import functools
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Registry of Kraken assets and pairs.
+#
+# Assets are interned to small integer ids (their position in the registry)
+# and every known spelling of them resolves to the same id:
+#   assets: Kraken code, code without its X / Z class prefix and common
+#           names, e.g. XXBT, XBT, BTC or ZEUR, EUR
+#   pairs:  AssetPairs key, altname and wsname, and every concatenation of
+#           base and quote aliases, e.g. XXBTZEUR, XBTEUR, BTCEUR, XBT/EUR
+#
+# The id of the pair trading base against quote is
+# `base_id * n_assets + quote_id`, whether the pair is listed in the cached
+# AssetPairs data or not, so lookups never add anything to the registry and
+# ids only depend on the content of the asset description file and of the
+# AssetPairs cache: they are the same in every process loading the same
+# files. Arrays indexed by pair id have `n_pairs` items.
+
+asset_desc_path = Path(__file__).parents[2] / 'krak_asset_desc.csv'
+asset_pairs_path = Path(__file__).parents[2] / 'data' / 'asset_pairs.json'
+asset_pairs_url = 'https://api.kraken.com/0/public/AssetPairs'
+
+# names used outside of Kraken for some assets (without class prefix)
+asset_synonyms = {
+    'XBT': ('BTC',),
+    'XDG': ('DOGE',),
+}
+
+_missing = object()
+
+
+def asset_aliases(code):
+    # Kraken code first, then the code without the X (crypto) or Z (fiat)
+    # prefix of legacy 4 letters codes, then synonyms
+    aliases = [code]
+    if len(code) == 4 and code[0] in 'XZ':
+        aliases.append(code[1:])
+    for alias in list(aliases):
+        aliases.extend(asset_synonyms.get(alias, ()))
+    return(aliases)
+
+
+def read_asset_desc(path=asset_desc_path):
+    # rows of the asset description file (Code;Desc;Type;Statut)
+    with open(path, newline='') as f:
+        return(list(csv.DictReader(f, delimiter=';')))
+
+
+def load_asset_pairs(path=asset_pairs_path):
+    # AssetPairs data as cached by `fetch_asset_pairs`, either the raw API
+    # response or its `result` member
+    with open(path) as f:
+        asset_pairs = json.load(f)
+    return(asset_pairs.get('result', asset_pairs))
+
+
+def fetch_asset_pairs(path=asset_pairs_path):
+    import requests
+    resp = requests.get(asset_pairs_url)
+    resp.raise_for_status()
+    errors = resp.json()['error']
+    if errors:
+        raise RuntimeError(f'AssetPairs request failed: {errors}')
+    asset_pairs = resp.json()['result']
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(asset_pairs, f)
+    return(asset_pairs)
+
+
+class AssetRegistry(object):
+    # interned assets and pairs with alias lookup in both directions
+    def __init__(self) -> None:
+        # by asset id
+        self.codes = []
+        self.altnames = []
+        self.names = []
+        self.descriptions = []
+        self.types = []
+        self.delisted = []
+        self.aliases = []
+        self._asset_ids = {}
+        # aliases and altnames of the pairs listed in AssetPairs
+        self._pair_ids = {}
+        self._pair_names = {}
+
+    @classmethod
+    def from_files(
+        cls,
+        asset_desc_path=asset_desc_path,
+        asset_pairs_path=asset_pairs_path,
+    ):
+        # the AssetPairs cache is optional, pairs are then only known by the
+        # concatenations of the aliases of their assets
+        registry = cls()
+        for row in read_asset_desc(asset_desc_path):
+            registry.add_asset(
+                row['Code'],
+                description=row['Desc'],
+                asset_type=row['Type'],
+                delisted=row['Statut'] == 'delisted',
+            )
+        if Path(asset_pairs_path).exists():
+            registry.add_asset_pairs(load_asset_pairs(asset_pairs_path))
+        return(registry)
+
+    @property
+    def n_assets(self):
+        return(len(self.codes))
+
+    @property
+    def n_pairs(self):
+        return(self.n_assets ** 2)
+
+    def add_asset(
+        self,
+        code,
+        description='',
+        asset_type='',
+        delisted=False,
+        aliases=(),
+    ):
+        # returns the id of the asset, an alias already taken by another
+        # asset keeps resolving to it. Pair ids depend on the number of
+        # assets, which can not change once pairs are listed.
+        if code in self._asset_ids:
+            return(self._asset_ids[code])
+        if self._pair_names:
+            raise RuntimeError(f'Asset {code} added after pairs')
+        asset_id = len(self.codes)
+        names = asset_aliases(code) + list(aliases)
+        self.codes.append(code)
+        self.altnames.append(names[1] if len(names) > 1 else code)
+        # common name: first synonym (BTC for XXBT), else the altname
+        self.names.append(
+            names[2] if len(names) > 2 else self.altnames[asset_id]
+        )
+        self.descriptions.append(description)
+        self.types.append(asset_type)
+        self.delisted.append(delisted)
+        self.aliases.append([])
+        for name in names:
+            if self._asset_ids.setdefault(name, asset_id) == asset_id:
+                self.aliases[asset_id].append(name)
+        return(asset_id)
+
+    def add_asset_pairs(self, asset_pairs):
+        # pairs of the `result` of the AssetPairs API, dark pool duplicates
+        # (`.d` keys) excluded. Their assets are added first, in the order
+        # of the data, so that ids do not depend on the order of lookups.
+        asset_pairs = {
+            key: desc for key, desc in asset_pairs.items()
+            if not key.endswith('.d')
+        }
+        for desc in asset_pairs.values():
+            self.add_asset(desc['base'])
+            self.add_asset(desc['quote'])
+        for key, desc in asset_pairs.items():
+            pair_id = self.pair(desc['base'], desc['quote'])
+            self._pair_names.setdefault(pair_id, desc.get('altname', key))
+            for alias in (key, desc.get('altname', key), desc.get('wsname')):
+                if alias:
+                    self._pair_ids.setdefault(alias, pair_id)
+
+    def asset_id(self, asset, default=_missing):
+        if isinstance(asset, (int, np.integer)):
+            return(int(asset))
+        asset_id = self._asset_ids.get(asset)
+        if asset_id is None:
+            if default is _missing:
+                raise KeyError(f'Unknown asset: {asset}')
+            return(default)
+        return(asset_id)
+
+    def asset_ids(self, assets, default=_missing):
+        return(
+            np.array(
+                [self.asset_id(asset, default=default) for asset in assets],
+                dtype=np.int64,
+            )
+        )
+
+    def same_asset(self, asset, other):
+        # whether two spellings name the same asset (ZEUR and EUR)
+        if asset == other:
+            return(True)
+        asset_id = self.asset_id(asset, default=None)
+        return(
+            asset_id is not None
+            and asset_id == self.asset_id(other, default=None)
+        )
+
+    def _split(self, name):
+        # (base id, quote id) of the assets spelled in `name`, preferring a
+        # split on a listed pair
+        if '/' in name:
+            base, _, quote = name.partition('/')
+            candidates = [(base, quote)]
+        else:
+            candidates = [(name[:k], name[k:]) for k in range(1, len(name))]
+        candidates = [
+            (self._asset_ids[base], self._asset_ids[quote])
+            for base, quote in candidates
+            if base in self._asset_ids and quote in self._asset_ids
+        ]
+        if not candidates:
+            raise KeyError(f'Unknown pair: {name}')
+        for base_id, quote_id in candidates:
+            if base_id * self.n_assets + quote_id in self._pair_names:
+                return(base_id, quote_id)
+        return(candidates[0])
+
+    def pair(self, base, quote, default=_missing):
+        # id of the pair trading `base` against `quote`
+        try:
+            base_id = self.asset_id(base)
+            quote_id = self.asset_id(quote)
+        except KeyError:
+            if default is _missing:
+                raise
+            return(default)
+        return(base_id * self.n_assets + quote_id)
+
+    def pairs(self, base_ids, quote_ids):
+        # ids of the pairs of arrays of asset ids, -1 where one is -1
+        base_ids = np.asarray(base_ids, dtype=np.int64)
+        quote_ids = np.asarray(quote_ids, dtype=np.int64)
+        return(
+            np.where(
+                (base_ids >= 0) & (quote_ids >= 0),
+                base_ids * self.n_assets + quote_ids,
+                -1,
+            )
+        )
+
+    def pair_id(self, pair, default=_missing):
+        # id of a pair from any of its names
+        if isinstance(pair, (int, np.integer)):
+            return(int(pair))
+        pair_id = self._pair_ids.get(pair)
+        if pair_id is not None:
+            return(pair_id)
+        try:
+            if not isinstance(pair, str):
+                raise KeyError(f'Unknown pair: {pair}')
+            base_id, quote_id = self._split(pair)
+        except KeyError:
+            if default is _missing:
+                raise
+            return(default)
+        return(base_id * self.n_assets + quote_id)
+
+    def pair_ids(self, pairs, default=_missing):
+        # array of the ids of `pairs`, each distinct name is resolved once
+        pairs = np.asarray(pairs, dtype=object)
+        inverse, names = pd.factorize(pairs.ravel())
+        ids = np.array(
+            [self.pair_id(name, default=default) for name in names],
+            dtype=np.int64,
+        )
+        return(ids[inverse].reshape(pairs.shape))
+
+    def pair_assets(self, pair_ids):
+        # (base ids, quote ids) of pair ids
+        return(divmod(pair_ids, self.n_assets))
+
+    def pair_name(self, pair_id):
+        # AssetPairs altname of listed pairs, concatenation of the altnames
+        # of their assets otherwise
+        if pair_id in self._pair_names:
+            return(self._pair_names[pair_id])
+        base_id, quote_id = self.pair_assets(pair_id)
+        return(self.altnames[base_id] + self.altnames[quote_id])
+
+    def column_positions(self, columns):
+        # array indexed by pair id of the position of the first column
+        # naming that pair, -1 for pairs without column. Columns which are
+        # not pairs are ignored.
+        positions = np.full(self.n_pairs, -1, dtype=np.int64)
+        column_ids = self.pair_ids(list(columns), default=-1)
+        pair_ids, first = np.unique(column_ids, return_index=True)
+        positions[pair_ids[pair_ids >= 0]] = first[pair_ids >= 0]
+        return(positions)
+
+    def __repr__(self):
+        return(
+            f'AssetRegistry(assets={len(self.codes)}, '
+            f'pairs={len(self._pair_names)} listed)'
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_registry():
+    # registry shared by the process, loaded on first use
+    return(AssetRegistry.from_files())
@@ -0,0 +1,387 @@
+import argparse
+import os
+import secrets
+import stat
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing.managers import BaseManager
+
+from services.hist_data.compact import CompactOHLC, fields, get_compact_ohlc
+
+
+# Shared memory OHLC store for research workers running on the same host.
+#
+# A server process loads the compact OHLC history of a (pair, freq) once into
+# a POSIX shared memory segment. Clients connect to it, attach to the segment
+# and get read-only CompactOHLC views on it, sliced to the requested range
+# without any copy, so N workers use one copy of the data. Segments are
+# reference counted per client; once unused they are kept while the idle
+# segments fit in `max_idle_bytes` and unlinked least recently used first.
+#
+# The references of a client are tied to its connections to the server
+# (each one is served by its own server thread): when every connection of a
+# client is closed, e.g. because the worker died without `close()`, its
+# references are dropped. Unlinking a segment does not invalidate the views
+# of clients still attached to it.
+#
+# Manager connections exchange pickles, so the authentication key gives
+# code execution as the server user: there is no default key. It is taken
+# from PYFI_SHM_AUTHKEY, or else from a key file (`authkey_path`) which the
+# server creates with a random key and mode 0600 and clients read. Segments
+# are created with mode 0600 too: clients must run as the same Unix user
+# as the server.
+#
+#   python -m services.hist_data.shared --port 50123      # server
+#
+#   with PriceMatrixClient(address=('127.0.0.1', 50123)) as client:
+#       ohlc = client.get('XBTEUR', 60, start=..., end=...)
+
+default_address = ('127.0.0.1', 50123)
+authkey_env_var = 'PYFI_SHM_AUTHKEY'
+authkey_path = Path.home() / '.pyfi' / 'shm_authkey'
+default_max_idle_bytes = 512 * 2 ** 20
+
+_alignment = 8
+
+# serializes segment creation with `_attach`, which briefly disables the
+# registration of shared memory segments with the resource tracker
+_tracker_lock = threading.Lock()
+
+
+def get_authkey(path=authkey_path, create=False):
+    # key of PYFI_SHM_AUTHKEY, else of the key file, created with a random
+    # key when `create` (server side) and missing
+    if os.environ.get(authkey_env_var):
+        return(os.environ[authkey_env_var].encode())
+    path = Path(path)
+    if create and not path.exists():
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    if not path.exists():
+        raise RuntimeError(
+            f'No shared memory authentication key: set {authkey_env_var} '
+            f'or start the server, which creates {path}'
+        )
+    if path.stat().st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise RuntimeError(
+            f'{path} is accessible by other users, restrict it to mode 0600'
+        )
+    key = path.read_text().strip()
+    if not key:
+        raise RuntimeError(f'Empty authentication key in {path}')
+    return(key.encode())
+
+
+def _layout(ohlc):
+    # offsets of each array in the segment, aligned on 8 bytes
+    layout = []
+    offset = 0
+    arrays = [(field, ohlc.columns[field]) for field in fields]
+    arrays.append(('valid_bits', ohlc.valid_bits))
+    for name, array in arrays:
+        layout.append((name, array.dtype.str, offset, len(array)))
+        offset += -(-array.nbytes // _alignment) * _alignment
+    return(layout, max(offset, 1))
+
+
+def _attach(name):
+    # clients must not let the resource tracker unlink the server segments
+    # when they exit (python < 3.13 registers every attached segment).
+    # Attached segments are never registered rather than unregistered
+    # afterwards: the tracker may be shared with the creator (same process,
+    # or a server forked from the client), whose registration must be kept.
+    try:
+        return(shared_memory.SharedMemory(name=name, track=False))
+    except TypeError:
+        pass
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+
+    def register_except_shared_memory(name, rtype):
+        if rtype != 'shared_memory':
+            register(name, rtype)
+
+    with _tracker_lock:
+        resource_tracker.register = register_except_shared_memory
+        try:
+            return(shared_memory.SharedMemory(name=name))
+        finally:
+            resource_tracker.register = register
+
+
+def _views(segment, descriptor):
+    arrays = {}
+    for name, dtype, offset, length in descriptor['layout']:
+        array = np.ndarray(
+            (length,),
+            dtype=np.dtype(dtype),
+            buffer=segment.buf,
+            offset=offset,
+        )
+        array.flags.writeable = False
+        arrays[name] = array
+    valid_bits = arrays.pop('valid_bits')
+    return(
+        CompactOHLC(
+            start=descriptor['start'],
+            freq=descriptor['freq'],
+            columns=arrays,
+            valid_bits=valid_bits,
+            n_bars=descriptor['n_bars'],
+            fill_policy=descriptor['fill_policy'],
+        )
+    )
+
+
+class SharedOHLCStore(object):
+    # server side registry of the shared memory segments
+    def __init__(
+        self,
+        loader=get_compact_ohlc,
+        max_idle_bytes=default_max_idle_bytes,
+    ) -> None:
+        self.loader = loader
+        self.max_idle_bytes = max_idle_bytes
+        self.entries = {}
+        # client -> threads serving its calls (one per connection)
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, pair, freq=60, client=None):
+        key = (pair, int(freq))
+        with self._lock:
+            self._reap()
+            self.clients.setdefault(client, set()).add(
+                threading.current_thread()
+            )
+            if key not in self.entries:
+                self.entries[key] = self._load(pair, int(freq))
+            entry = self.entries[key]
+            entry['holders'][client] = entry['holders'].get(client, 0) + 1
+            self._evict()
+            return(entry['descriptor'])
+
+    def release(self, pair, freq=60, client=None):
+        key = (pair, int(freq))
+        with self._lock:
+            self._reap()
+            entry = self.entries.get(key)
+            if entry is None or not entry['holders'].get(client):
+                raise RuntimeError(f'{pair} at {freq}sec is not acquired')
+            entry['holders'][client] -= 1
+            if not entry['holders'][client]:
+                del entry['holders'][client]
+            if not entry['holders']:
+                entry['released_at'] = time.monotonic()
+            self._evict()
+
+    def release_client(self, client):
+        # drops every reference held by `client`
+        with self._lock:
+            self._drop(client)
+            self._evict()
+
+    def _drop(self, client):
+        self.clients.pop(client, None)
+        for entry in self.entries.values():
+            if entry['holders'].pop(client, None) and not entry['holders']:
+                entry['released_at'] = time.monotonic()
+
+    def _reap(self):
+        # drops the references of clients whose connections are all closed
+        for client, threads in list(self.clients.items()):
+            alive = {thread for thread in threads if thread.is_alive()}
+            if alive:
+                self.clients[client] = alive
+            else:
+                self._drop(client)
+
+    def _load(self, pair, freq):
+        ohlc = self.loader(pair, freq)
+        layout, size = _layout(ohlc)
+        with _tracker_lock:
+            segment = shared_memory.SharedMemory(create=True, size=size)
+        descriptor = {
+            'name': segment.name,
+            'start': ohlc.start,
+            'freq': ohlc.freq,
+            'n_bars': ohlc.n_bars,
+            'fill_policy': ohlc.fill_policy,
+            'layout': layout,
+        }
+        for (name, dtype, offset, length), array in zip(
+            layout,
+            [ohlc.columns[field] for field in fields] + [ohlc.valid_bits],
+        ):
+            np.ndarray(
+                (length,),
+                dtype=np.dtype(dtype),
+                buffer=segment.buf,
+                offset=offset,
+            )[:] = array
+        return({
+            'segment': segment,
+            'descriptor': descriptor,
+            'holders': {},
+            'released_at': time.monotonic(),
+        })
+
+    def _evict(self):
+        idle = sorted(
+            (
+                (entry['released_at'], key)
+                for key, entry in self.entries.items()
+                if not entry['holders']
+            ),
+        )
+        idle_bytes = sum(self.entries[key]['segment'].size for _, key in idle)
+        for _, key in idle:
+            if idle_bytes <= self.max_idle_bytes:
+                break
+            entry = self.entries.pop(key)
+            idle_bytes -= entry['segment'].size
+            self._unlink(entry['segment'])
+
+    @staticmethod
+    def _unlink(segment):
+        segment.close()
+        segment.unlink()
+
+    def stats(self):
+        with self._lock:
+            self._reap()
+            self._evict()
+            return({
+                f'{pair}_{freq}sec': {
+                    'refcount': sum(entry['holders'].values()),
+                    'clients': len(entry['holders']),
+                    'bytes': entry['segment'].size,
+                }
+                for (pair, freq), entry in self.entries.items()
+            })
+
+    def close(self):
+        with self._lock:
+            for entry in self.entries.values():
+                self._unlink(entry['segment'])
+            self.entries = {}
+            self.clients = {}
+
+
+class PriceMatrixManager(BaseManager):
+    pass
+
+
+def serve(
+    address=default_address,
+    authkey=None,
+    max_idle_bytes=default_max_idle_bytes,
+    loader=get_compact_ohlc,
+):
+    if authkey is None:
+        authkey = get_authkey(create=True)
+    store = SharedOHLCStore(loader=loader, max_idle_bytes=max_idle_bytes)
+    PriceMatrixManager.register('store', callable=lambda: store)
+    manager = PriceMatrixManager(address=address, authkey=authkey)
+    try:
+        manager.get_server().serve_forever()
+    finally:
+        store.close()
+
+
+class PriceMatrixClient(object):
+    # client side: attaches segments and hands out read-only views. Either
+    # connects to a server at `address` or uses a local `store` directly.
+    def __init__(
+        self,
+        address=default_address,
+        authkey=None,
+        store=None,
+    ) -> None:
+        if store is None:
+            if authkey is None:
+                authkey = get_authkey()
+            PriceMatrixManager.register('store')
+            manager = PriceMatrixManager(address=address, authkey=authkey)
+            manager.connect()
+            store = manager.store()
+        self.store = store
+        self.client_id = uuid.uuid4().hex
+        self.attached = {}
+
+    def get(self, pair, freq=60, start=None, end=None):
+        # read-only CompactOHLC on the bars overlapping [start, end[, given
+        # as epoch seconds; the whole history is shared, slicing is free
+        key = (pair, int(freq))
+        if key not in self.attached:
+            descriptor = self.store.acquire(pair, int(freq), self.client_id)
+            segment = _attach(descriptor['name'])
+            self.attached[key] = {
+                'segment': segment,
+                'ohlc': _views(segment, descriptor),
+                'refcount': 0,
+            }
+        entry = self.attached[key]
+        entry['refcount'] += 1
+        if start is None and end is None:
+            return(entry['ohlc'])
+        return(entry['ohlc'].slice(start, end))
+
+    def release(self, pair, freq=60):
+        key = (pair, int(freq))
+        entry = self.attached.get(key)
+        if entry is None:
+            raise RuntimeError(f'{pair} at {freq}sec is not attached')
+        entry['refcount'] -= 1
+        if entry['refcount'] == 0:
+            self._detach(key)
+
+    def _detach(self, key):
+        entry = self.attached.pop(key)
+        entry.pop('ohlc')
+        try:
+            entry['segment'].close()
+        except BufferError:
+            # views are still referenced by the caller, the mapping is
+            # released when they are garbage collected
+            pass
+        self.store.release(*key, self.client_id)
+
+    def close(self):
+        for key in list(self.attached):
+            self._detach(key)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve cached OHLC histories through shared memory',
+    )
+    parser.add_argument('--host', default=default_address[0])
+    parser.add_argument('--port', type=int, default=default_address[1])
+    parser.add_argument(
+        '--max-idle-mb',
+        type=int,
+        default=default_max_idle_bytes // 2 ** 20,
+    )
+    args = parser.parse_args()
+    serve(
+        address=(args.host, args.port),
+        max_idle_bytes=args.max_idle_mb * 2 ** 20,
+    )
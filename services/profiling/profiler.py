@@ -0,0 +1,289 @@
+import atexit
+import functools
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Opt-in instrumentation of the backtest pipeline.
+#
+# Stages are declared with the `profiled` decorator or the `stage` context
+# manager. Nothing is recorded unless a profiler is active, either through
+# the `profiling` context manager:
+#
+#   with profiling(report_path='report.json', cprofile_path='run.prof'):
+#       strategy.evaluate(price_history=..., initial_portfolio=...)
+#
+# or by setting the PYFI_PROFILE environment variable before import
+# (PYFI_PROFILE=1 writes `pyfi_profile.json` in the working directory at
+# exit, any other value is used as the report path). PYFI_PROFILE_CPROFILE=1
+# additionally dumps cProfile statistics next to the report.
+#
+# Peak memory per stage is only recorded with `trace_memory=True` (or
+# PYFI_PROFILE_MEMORY=1). tracemalloc slows allocations down several times,
+# so wall times of such a run are not representative: measure time and
+# memory in separate runs.
+
+ENV_VAR = 'PYFI_PROFILE'
+ENV_VAR_CPROFILE = 'PYFI_PROFILE_CPROFILE'
+ENV_VAR_MEMORY = 'PYFI_PROFILE_MEMORY'
+default_report_path = Path('.') / 'pyfi_profile.json'
+
+_active = None
+# profilers shadowed by a nested `profiling` block
+_shadowed = []
+
+
+class StageStats(object):
+    # accumulated measures for one named stage
+    def __init__(self, name) -> None:
+        self.name = name
+        self.calls = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.peak_memory = 0
+
+    def add(self, elapsed, peak_memory=0):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def as_dict(self):
+        return({
+            'calls': self.calls,
+            'total_time_s': self.total_time,
+            'mean_time_s': self.total_time / self.calls if self.calls else 0.,
+            'max_time_s': self.max_time,
+            'peak_memory_bytes': self.peak_memory,
+        })
+
+
+class Profiler(object):
+    # records wall time, call counts and peak memory per pipeline stage
+    def __init__(
+        self,
+        trace_memory=False,
+        cprofile=False,
+    ) -> None:
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.stages = {}
+        # wall time per nested stage path, used for flame graph output
+        self.stacks = {}
+        self._stack = []
+        self._cprofile = None
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if self.cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _enter(self, name):
+        frame = [name, time.perf_counter(), 0, 0]
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][3] = max(self._stack[-1][3], peak)
+            _reset_peak()
+            frame[2] = frame[3] = current
+        self._stack.append(frame)
+
+    def _exit(self):
+        name, start, start_memory, peak_memory = self._stack[-1]
+        elapsed = time.perf_counter() - start
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+            _reset_peak()
+        path = ';'.join(frame[0] for frame in self._stack)
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1][3] = max(self._stack[-1][3], peak_memory)
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+        self.stages[name].add(elapsed, peak_memory - start_memory)
+        self.stacks[path] = self.stacks.get(path, 0.) + elapsed
+
+    def report(self):
+        # peak memory is left out when it was not traced
+        report = {
+            name: stats.as_dict()
+            for name, stats in self.stages.items()
+        }
+        if not self.trace_memory:
+            for stats in report.values():
+                del stats['peak_memory_bytes']
+        return(report)
+
+    def to_frame(self):
+        import pandas as pd
+        return(
+            pd.DataFrame.from_dict(self.report(), orient='index')
+            .sort_values('total_time_s', ascending=False)
+        )
+
+    def write_report(self, path):
+        path = Path(path)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return(path)
+
+    def write_cprofile(self, path):
+        if self._cprofile is None:
+            raise RuntimeError('cProfile was not enabled for this profiler')
+        self._cprofile.dump_stats(str(path))
+        return(Path(path))
+
+    def write_folded(self, path):
+        # stage level flame graph, in the collapsed stack format read by
+        # flamegraph.pl and speedscope (self time in microseconds)
+        self_times = dict(self.stacks)
+        for stack_path, elapsed in self.stacks.items():
+            parent = stack_path.rpartition(';')[0]
+            if parent in self_times:
+                self_times[parent] -= elapsed
+        with open(path, 'w') as f:
+            for stack_path, elapsed in self_times.items():
+                f.write(f'{stack_path} {max(int(elapsed * 1e6), 0)}\n')
+        return(Path(path))
+
+    def __repr__(self):
+        return(repr(self.to_frame()))
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak only exists from python 3.9, peaks are then
+    # measured since the start of tracing
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def get_active_profiler():
+    return(_active)
+
+
+def enable(profiler=None):
+    # activates a profiler, a currently active one is shadowed until the
+    # matching call to `disable`
+    global _active
+    if profiler is None:
+        profiler = Profiler()
+    if _active is not None:
+        _shadowed.append(_active)
+    profiler.start()
+    _active = profiler
+    return(profiler)
+
+
+def disable():
+    global _active
+    profiler = _active
+    if profiler is not None:
+        profiler.stop()
+    _active = _shadowed.pop() if _shadowed else None
+    return(profiler)
+
+
+@contextmanager
+def profiling(
+    report_path=None,
+    cprofile_path=None,
+    folded_path=None,
+    trace_memory=False,
+):
+    profiler = enable(
+        Profiler(
+            trace_memory=trace_memory,
+            cprofile=cprofile_path is not None,
+        )
+    )
+    try:
+        yield profiler
+    finally:
+        disable()
+        if report_path is not None:
+            profiler.write_report(report_path)
+        if cprofile_path is not None:
+            profiler.write_cprofile(cprofile_path)
+        if folded_path is not None:
+            profiler.write_folded(folded_path)
+
+
+@contextmanager
+def stage(name):
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    profiler._enter(name)
+    try:
+        yield
+    finally:
+        profiler._exit()
+
+
+def profiled(name=None):
+    # decorator marking a function as a pipeline stage, the only cost when
+    # profiling is disabled is a global lookup
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return(func(*args, **kwargs))
+            profiler._enter(stage_name)
+            try:
+                return(func(*args, **kwargs))
+            finally:
+                profiler._exit()
+        return(wrapper)
+
+    if callable(name):
+        func, name = name, None
+        return(decorator(func))
+    return(decorator)
+
+
+def _enable_from_environment():
+    value = os.environ.get(ENV_VAR, '')
+    if value.lower() in ('', '0', 'false', 'no'):
+        return
+    if value.lower() in ('1', 'true', 'yes'):
+        report_path = default_report_path
+    else:
+        report_path = Path(value)
+    profiler = enable(
+        Profiler(
+            trace_memory=os.environ.get(ENV_VAR_MEMORY, '') == '1',
+            cprofile=os.environ.get(ENV_VAR_CPROFILE, '') == '1',
+        )
+    )
+
+    def write_reports():
+        disable()
+        profiler.write_report(report_path)
+        profiler.write_folded(report_path.with_suffix('.folded'))
+        if profiler.cprofile:
+            profiler.write_cprofile(report_path.with_suffix('.prof'))
+
+    atexit.register(write_reports)
+
+
+_enable_from_environment()
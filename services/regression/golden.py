@@ -0,0 +1,725 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import math
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from services.hist_data.compact import CompactOHLC, price_history
+from services.hist_data.history import get_ohlc
+from services.strategies.execution import ExecutionModel
+from services.strategies.kernels import crossover_events
+from services.strategies.robustness import evaluate_paths
+from services.strategies.sizing import EqualRisk, FixedFraction
+from services.strategies.sizing import VolatilityTarget
+from services.strategies.strategies import CrossAverageStrategy
+from services.strategies.strategies import VirtualPortfolio
+
+
+# Golden outputs of the backtest pipeline.
+#
+# Seeded synthetic trades and price histories are run through `get_ohlc`,
+# `generate_signals`, `evaluate` (with and without sizers),
+# `eval_performance` and `ExecutionModel.costs` for a grid of parameters.
+# Histories are random walks, the same quoted to a tick with forward filled
+# gaps, or the forward filled `get_ohlc` closes of the synthetic trades; the
+# last two have flat runs where short and long means tie.
+# `record` stores their outputs and timings in a JSON file, `check` reruns
+# them and compares the outputs within tolerance, reporting timings next to
+# the recorded ones. Alternative implementations of a target (e.g. the
+# vectorized kernels, or the trade by trade paths) are checked against the
+# same goldens.
+#
+#   python -m services.regression.golden check
+#   python -m services.regression.golden record   # after intended changes
+
+golden_path = Path(__file__).parent / 'goldens.json'
+
+# 2021-06-01 00:00 UTC, away from daylight saving time changes
+synthetic_start = 1622505600
+
+
+def synthetic_trades(
+    seed,
+    n_trades=20000,
+    duration=2 * 86400,
+    initial_price=30000.,
+    volatility=2e-4,
+):
+    # trades at random times with a random walk price, in the layout of the
+    # Kraken trades CSV files read by `get_trades`
+    rng = np.random.default_rng(seed)
+    timestamps = np.sort(
+        synthetic_start + rng.random(n_trades) * duration
+    ).round(4)
+    prices = initial_price * np.exp(
+        np.cumsum(rng.normal(0, volatility, n_trades))
+    )
+    return(
+        pd.DataFrame({
+            'timestamp': timestamps,
+            'price': prices.round(1),
+            'volume': rng.exponential(0.05, n_trades).round(8),
+        })
+    )
+
+
+def synthetic_price_history(
+    seed,
+    n_bars=5000,
+    freq='60s',
+    pairs=('BTCEUR',),
+    initial_price=30000.,
+    volatility=1e-3,
+    tick=None,
+    gap_rate=0.,
+):
+    # random walk prices, optionally quoted to `tick` with a `gap_rate`
+    # share of bars without price forward filled: both make flat runs where
+    # short and long means are equal
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(
+        pd.Timestamp(synthetic_start, unit='s'),
+        periods=n_bars,
+        freq=freq,
+        name='datetime',
+    )
+    history = pd.DataFrame(
+        {
+            pair: initial_price * np.exp(
+                np.cumsum(rng.normal(0, volatility, n_bars))
+            )
+            for pair in pairs
+        },
+        index=index,
+    )
+    if tick is not None:
+        history = (history / tick).round() * tick
+    if gap_rate:
+        gaps = rng.random(history.shape) < gap_rate
+        gaps[0] = False
+        history = history.mask(gaps).ffill()
+    return(history)
+
+
+# price history parameters of a case, on top of its seed
+history_params = ('volatility', 'tick', 'gap_rate')
+
+
+def _price_history(params, data_path):
+    # closes of the `get_ohlc` bars of the synthetic trades of the seed
+    # when the case has an `ohlc_freq` (quoted to 0.1, empty bars forward
+    # filled), a synthetic random walk otherwise
+    if 'ohlc_freq' in params:
+        ohlc = get_ohlc(
+            f"SYN{params['seed']}EUR",
+            int_freq=params['ohlc_freq'],
+            compute_datetime=False,
+            data_path=data_path,
+        )
+        return(
+            price_history({
+                'BTCEUR': CompactOHLC.from_frame(
+                    ohlc,
+                    params['ohlc_freq'],
+                    dtype=np.float64,
+                ),
+            })
+        )
+    return(
+        synthetic_price_history(
+            params['seed'],
+            **{key: params[key] for key in history_params if key in params},
+        )
+    )
+
+
+def _trades_seeds(cases):
+    # seeds of the synthetic trades files read by the cases
+    return({
+        params['seed'] for target, params in cases
+        if target == 'get_ohlc' or 'ohlc_freq' in params
+    })
+
+
+def write_synthetic_data(data_path, seeds):
+    # trades files named after the seed, and an empty ohlc cache
+    (data_path / 'trades').mkdir(parents=True, exist_ok=True)
+    (data_path / 'ohlc').mkdir(parents=True, exist_ok=True)
+    for seed in seeds:
+        synthetic_trades(seed).to_csv(
+            data_path / 'trades' / f'SYN{seed}EUR.csv',
+            index=False,
+            header=False,
+        )
+
+
+def _quiet(func, *args, **kwargs):
+    # eval_performance prints its results
+    with contextlib.redirect_stdout(io.StringIO()):
+        return(func(*args, **kwargs))
+
+
+def _frame_summary(frame):
+    return({
+        'rows': len(frame),
+        'columns': list(frame.columns),
+        'sums': {col: float(frame[col].sum()) for col in frame.columns},
+        'mins': {col: float(frame[col].min()) for col in frame.columns},
+        'maxs': {col: float(frame[col].max()) for col in frame.columns},
+        'first': [float(x) for x in frame.iloc[0]],
+        'last': [float(x) for x in frame.iloc[-1]],
+    })
+
+
+def _floats(values):
+    return({key: float(value) for key, value in values.items()})
+
+
+# targets: functions of (params, data_path) returning JSON-able outputs
+
+def target_get_ohlc(params, data_path):
+    ohlc = get_ohlc(
+        f"SYN{params['seed']}EUR",
+        int_freq=params['int_freq'],
+        compute_datetime=False,
+        data_path=data_path,
+    )
+    return(_frame_summary(ohlc))
+
+
+def target_generate_signals(params, data_path):
+    history = _price_history(params, data_path)
+    strategy = CrossAverageStrategy(
+        trading_pair='BTCEUR',
+        short_window=params['short_window'],
+        long_window=params['long_window'],
+    )
+    signals = strategy.generate_signals(history)
+    return({
+        'bars': [int(history.index.get_loc(s.datetime)) for s in signals],
+        'types': [s.signal_type for s in signals],
+    })
+
+
+def target_crossover_events(params, data_path):
+    history = _price_history(params, data_path)
+    events = crossover_events(
+        history['BTCEUR'].to_numpy(),
+        params['short_window'],
+        params['long_window'],
+    )
+    return({
+        'bars': [int(bar) for bar in events.bar],
+        'types': ['buy' if d > 0 else 'sell' for d in events.direction],
+    })
+
+
+def target_evaluate(params, data_path):
+    history = _price_history(params, data_path)
+    portfolio = VirtualPortfolio(
+        initial_volumes={'EUR': 1000.},
+        datetimes=history.index,
+        fee_rate=params['fee_rate'],
+    )
+    strategy = CrossAverageStrategy(
+        trading_pair='BTCEUR',
+        short_window=params['short_window'],
+        long_window=params['long_window'],
+    )
+    metrics = _quiet(
+        strategy.evaluate,
+        price_history=history,
+        initial_portfolio=portfolio,
+    )
+    return({
+        'metrics': _floats(metrics),
+        'final_assets': _floats(portfolio.assets.iloc[-1]),
+    })
+
+
+def target_evaluate_paths(params, data_path):
+    history = _price_history(params, data_path)
+    duration = history.index.max() - history.index.min()
+    metrics = evaluate_paths(
+        history['BTCEUR'].to_numpy()[None, :],
+        params['short_window'],
+        params['long_window'],
+        duration / pd.Timedelta(days=365),
+        fee_rate=params['fee_rate'],
+    )
+    return({
+        'metrics': {key: float(value[0]) for key, value in metrics.items()},
+    })
+
+
+def target_evaluate_trades(params, data_path):
+    # trade by trade evaluation of the signals with the whole portfolio
+    history = _price_history(params, data_path)
+    portfolio = VirtualPortfolio(
+        initial_volumes={'EUR': 1000.},
+        datetimes=history.index,
+        fee_rate=params['fee_rate'],
+    )
+    strategy = CrossAverageStrategy(
+        trading_pair='BTCEUR',
+        short_window=params['short_window'],
+        long_window=params['long_window'],
+    )
+    signals = strategy.generate_signals(history)
+    if signals and signals[0].signal_type == 'sell':
+        signals = signals[1:]
+    for signal in signals:
+        portfolio.pretty_trade(
+            'BTC',
+            'EUR',
+            price=history.loc[signal.datetime, 'BTCEUR'],
+            trade_type=signal.signal_type,
+            datetime=signal.datetime,
+        )
+    return({
+        'metrics': _floats(
+            _quiet(portfolio.eval_performance, prices_history=history)
+        ),
+        'final_assets': _floats(portfolio.assets.iloc[-1]),
+    })
+
+
+sizers = {
+    'full': FixedFraction,
+    'fixed_fraction': functools.partial(FixedFraction, fraction=0.5),
+    'volatility_target': functools.partial(VolatilityTarget, lookback=120),
+    'volatility_target_bar': functools.partial(
+        VolatilityTarget,
+        lookback=120,
+        resize='bar',
+    ),
+    'equal_risk': functools.partial(EqualRisk, lookback=120),
+}
+
+
+def target_evaluate_sized(params, data_path):
+    # evaluation with a sizer, from a portfolio which may already hold BTC
+    history = _price_history(params, data_path)
+    portfolio = VirtualPortfolio(
+        initial_volumes={'EUR': 1000., 'BTC': params['initial_btc']},
+        datetimes=history.index,
+    )
+    strategy = CrossAverageStrategy(
+        trading_pair='BTCEUR',
+        short_window=params['short_window'],
+        long_window=params['long_window'],
+    )
+    sizer = sizers[params['sizer']]()
+    weights = strategy.target_weights(history, sizer=sizer)
+    metrics = _quiet(
+        strategy.evaluate,
+        price_history=history,
+        initial_portfolio=portfolio,
+        sizer=sizer,
+    )
+    return({
+        'weights': {
+            'sum': float(weights.sum()),
+            'changes': int((np.diff(weights, axis=0) != 0).sum()),
+        },
+        'metrics': _floats(metrics),
+        'final_assets': _floats(portfolio.assets.iloc[-1]),
+    })
+
+
+def _execution_fills(seed, n_fills=200):
+    # fills of random volumes at random bars of a synthetic history
+    history = synthetic_price_history(seed)
+    rng = np.random.default_rng(seed)
+    bars = np.sort(rng.choice(len(history), n_fills, replace=False))
+    spreads = pd.Series(
+        np.linspace(0.002, 0.0005, len(history)),
+        index=history.index,
+    )
+    return(
+        history.index[bars],
+        rng.exponential(0.5, n_fills),
+        history['BTCEUR'].to_numpy()[bars],
+        spreads,
+    )
+
+
+def _execution_model(params, spreads):
+    # minimum size and spreads keyed by other spellings of the traded pair
+    return(
+        ExecutionModel(
+            min_order_sizes={'XBTEUR': params['min_order_size']},
+            spreads={'BTCEUR': spreads},
+            slippage_rate=0.0002,
+            maker=params['maker'],
+        )
+    )
+
+
+def _costs_summary(costs):
+    return({
+        'executed': int(np.sum(costs['executed'])),
+        'fee_rates': [float(rate) for rate in costs['fee_rate']],
+        'totals': {
+            key: float(np.sum(costs[key]))
+            for key in ('notional', 'fees', 'slippage', 'total')
+        },
+    })
+
+
+def target_execution_costs(params, data_path):
+    datetimes, volumes, prices, spreads = _execution_fills(params['seed'])
+    model = _execution_model(params, spreads)
+    return(
+        _costs_summary(
+            model.costs(
+                datetimes.to_numpy(),
+                volumes,
+                prices,
+                pairs='XXBTZEUR',
+            )
+        )
+    )
+
+
+def target_execution_trade_costs(params, data_path):
+    # fill by fill pricing, earlier executed fills passed as prior fills
+    datetimes, volumes, prices, spreads = _execution_fills(params['seed'])
+    model = _execution_model(params, spreads)
+    fills = []
+    for k, (datetime, volume, price) in enumerate(
+        zip(datetimes, volumes, prices)
+    ):
+        executed = [fill['executed'] for fill in fills]
+        fills.append(
+            model.trade_costs(
+                datetime,
+                volume,
+                price,
+                pair='XXBTZEUR',
+                prior_fills=(
+                    datetimes[:k][executed],
+                    np.array([fill['notional'] for fill in fills])[executed],
+                ),
+            )
+        )
+    return(
+        _costs_summary({
+            key: np.array([fill[key] for fill in fills])
+            for key in fills[0]
+        })
+    )
+
+
+def target_eval_performance(params, data_path):
+    # fixed round trips, independent of the signal generation
+    history = _price_history(params, data_path)
+    portfolio = VirtualPortfolio(
+        initial_volumes={'EUR': 1000.},
+        datetimes=history.index,
+    )
+    for position, trade_type in zip(params['bars'], params['types']):
+        portfolio.pretty_trade(
+            'BTC',
+            'EUR',
+            price=history['BTCEUR'].iloc[position],
+            trade_type=trade_type,
+            datetime=history.index[position],
+        )
+    return({
+        'metrics': _floats(
+            _quiet(portfolio.eval_performance, prices_history=history)
+        ),
+    })
+
+
+# target recorded in the goldens, and alternative implementations checked
+# against the same outputs
+targets = {
+    'get_ohlc': (target_get_ohlc, []),
+    'generate_signals': (
+        target_generate_signals,
+        [('crossover_events', target_crossover_events)],
+    ),
+    'evaluate': (
+        target_evaluate,
+        [
+            ('evaluate_paths', target_evaluate_paths),
+            ('evaluate_trades', target_evaluate_trades),
+        ],
+    ),
+    'evaluate_sized': (target_evaluate_sized, []),
+    'eval_performance': (target_eval_performance, []),
+    'execution_costs': (
+        target_execution_costs,
+        [('execution_trade_costs', target_execution_trade_costs)],
+    ),
+}
+
+
+def cases():
+    windows = [(5, 20), (10, 50), (30, 120)]
+    # flat runs of quoted and forward filled prices, with ties of the means
+    flat = {'volatility': 2e-5, 'tick': 0.1, 'gap_rate': 0.2}
+    for seed in (0, 1, 2):
+        for int_freq in (60, 300):
+            yield('get_ohlc', {'seed': seed, 'int_freq': int_freq})
+    for seed in (0, 1):
+        for short_window, long_window in windows:
+            yield(
+                'generate_signals',
+                {
+                    'seed': seed,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                },
+            )
+            for fee_rate in (0.0026, 0.001):
+                yield(
+                    'evaluate',
+                    {
+                        'seed': seed,
+                        'short_window': short_window,
+                        'long_window': long_window,
+                        'fee_rate': fee_rate,
+                    },
+                )
+        for short_window, long_window in [(3, 10)] + windows:
+            yield(
+                'generate_signals',
+                {
+                    'seed': seed,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                    **flat,
+                },
+            )
+            yield(
+                'evaluate',
+                {
+                    'seed': seed,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                    'fee_rate': 0.0026,
+                    **flat,
+                },
+            )
+        yield(
+            'eval_performance',
+            {
+                'seed': seed,
+                'bars': [100, 900, 1500, 4000],
+                'types': ['buy', 'sell', 'buy', 'sell'],
+            },
+        )
+    # closes of 10 seconds bars of the synthetic trades, with forward
+    # filled empty bars
+    for seed in (0, 1):
+        for short_window, long_window in [(3, 10), (5, 20), (10, 50)]:
+            yield(
+                'generate_signals',
+                {
+                    'seed': seed,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                    'ohlc_freq': 10,
+                },
+            )
+            yield(
+                'evaluate',
+                {
+                    'seed': seed,
+                    'short_window': short_window,
+                    'long_window': long_window,
+                    'fee_rate': 0.0026,
+                    'ohlc_freq': 10,
+                },
+            )
+    for sizer in ('volatility_target', 'equal_risk'):
+        yield(
+            'evaluate_sized',
+            {
+                'seed': 0,
+                'short_window': 5,
+                'long_window': 20,
+                'sizer': sizer,
+                'initial_btc': 0.05,
+                'ohlc_freq': 10,
+            },
+        )
+    for sizer in sizers:
+        for initial_btc in (0., 0.05):
+            yield(
+                'evaluate_sized',
+                {
+                    'seed': 0,
+                    'short_window': 10,
+                    'long_window': 50,
+                    'sizer': sizer,
+                    'initial_btc': initial_btc,
+                },
+            )
+    for seed in (0, 1):
+        for min_order_size in (0., 0.5):
+            for maker in (False, True):
+                yield(
+                    'execution_costs',
+                    {
+                        'seed': seed,
+                        'min_order_size': min_order_size,
+                        'maker': maker,
+                    },
+                )
+
+
+def case_id(target, params):
+    return(
+        target + '[' + ','.join(
+            f'{key}={value}' for key, value in params.items()
+            if key not in ('bars', 'types')
+        ) + ']'
+    )
+
+
+def _run(func, params, data_path):
+    start = time.perf_counter()
+    outputs = func(params, data_path)
+    return(outputs, time.perf_counter() - start)
+
+
+def _versions():
+    return({
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    })
+
+
+def record(path=golden_path):
+    goldens = {}
+    all_cases = list(cases())
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp)
+        write_synthetic_data(data_path, _trades_seeds(all_cases))
+        for target, params in all_cases:
+            outputs, elapsed = _run(targets[target][0], params, data_path)
+            goldens[case_id(target, params)] = {
+                'target': target,
+                'params': params,
+                'outputs': outputs,
+                'elapsed_s': elapsed,
+            }
+    with open(path, 'w') as f:
+        json.dump(
+            {'versions': _versions(), 'cases': goldens},
+            f,
+            indent=1,
+            sort_keys=True,
+        )
+    return(path)
+
+
+def compare(expected, actual, rtol=1e-7, atol=1e-9, where=''):
+    # list of differences between nested outputs, numbers within tolerance
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if set(expected) != set(actual):
+            return([f'{where}: keys {sorted(expected)} != {sorted(actual)}'])
+        return([
+            difference
+            for key in expected
+            for difference in compare(
+                expected[key], actual[key], rtol, atol, f'{where}.{key}'
+            )
+        ])
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return([f'{where}: length {len(expected)} != {len(actual)}'])
+        return([
+            difference
+            for k, (e, a) in enumerate(zip(expected, actual))
+            for difference in compare(e, a, rtol, atol, f'{where}[{k}]')
+        ])
+    if isinstance(expected, float) or isinstance(actual, float):
+        if math.isnan(expected) and math.isnan(actual):
+            return([])
+        if not math.isclose(expected, actual, rel_tol=rtol, abs_tol=atol):
+            return([f'{where}: {expected!r} != {actual!r}'])
+        return([])
+    if expected != actual:
+        return([f'{where}: {expected!r} != {actual!r}'])
+    return([])
+
+
+def check(path=golden_path, rtol=1e-7, atol=1e-9, alternatives=True):
+    # reruns every golden case (and the alternative implementations of its
+    # target) and returns one row per run with differences and timings
+    with open(path) as f:
+        goldens = json.load(f)['cases']
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp)
+        write_synthetic_data(
+            data_path,
+            _trades_seeds(
+                (case['target'], case['params'])
+                for case in goldens.values()
+            ),
+        )
+        for name, case in goldens.items():
+            reference, others = targets[case['target']]
+            implementations = [(case['target'], reference)]
+            if alternatives:
+                implementations += others
+            for implementation, func in implementations:
+                outputs, elapsed = _run(func, case['params'], data_path)
+                # alternatives may only produce part of the outputs
+                expected = {
+                    key: value for key, value in case['outputs'].items()
+                    if key in outputs
+                }
+                differences = compare(expected, outputs, rtol, atol)
+                rows.append({
+                    'case': name,
+                    'implementation': implementation,
+                    'ok': not differences,
+                    'differences': differences,
+                    'elapsed_s': elapsed,
+                    'golden_elapsed_s': case['elapsed_s'],
+                })
+    return(pd.DataFrame(rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Record or check golden outputs of the pipeline',
+    )
+    parser.add_argument('action', choices=['record', 'check'])
+    parser.add_argument('--path', type=Path, default=golden_path)
+    parser.add_argument('--rtol', type=float, default=1e-7)
+    parser.add_argument('--atol', type=float, default=1e-9)
+    args = parser.parse_args()
+    if args.action == 'record':
+        print(f'Goldens written to {record(args.path)}')
+        sys.exit(0)
+    report = check(args.path, rtol=args.rtol, atol=args.atol)
+    timings = report.groupby('implementation')[
+        ['elapsed_s', 'golden_elapsed_s']
+    ].sum()
+    print(timings.assign(speedup=timings['golden_elapsed_s'] / timings[
+        'elapsed_s']).to_string())
+    failures = report[~report['ok']]
+    for _, row in failures.iterrows():
+        print(f"FAILED {row['case']} ({row['implementation']})")
+        for difference in row['differences'][:10]:
+            print(f'    {difference}')
+    print(f'{len(report) - len(failures)} passed, {len(failures)} failed')
+    sys.exit(1 if len(failures) else 0)
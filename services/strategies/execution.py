@@ -0,0 +1,362 @@
+import numpy as np
+import pandas as pd
+from dateutil import tz
+
+from services.hist_data.registry import get_registry
+from services.profiling.profiler import profiled
+
+
+# Execution costs of fills: exchange fees, spread and slippage.
+#
+# Every cost is computed with array operations over a whole array of fills
+# (`ExecutionModel.costs`), so that sweep and Monte Carlo engines can price
+# thousands of fills at once. `ExecutionModel.trade_costs` prices a single
+# fill for the trade by trade path of `VirtualPortfolio`. Models hold no
+# state: the earlier fills counted in the 30 days volume of volume based fee
+# tiers are passed as `prior_fills` by their owner (the portfolio).
+#
+# Notionals are in the quote currency of the pair. `quote_rates` convert them
+# into the reporting currency of the portfolio (price of the quote currency
+# in the reporting one at the time of the fill, 1 when they are the same);
+# all costs and the 30 days volume are expressed in the reporting currency.
+#
+# Pairs are given by name in any spelling known to the asset registry, or by
+# pair id; per pair settings are looked up by pair id.
+
+# Kraken spot fee schedule: 30 days volume, maker fee, taker fee
+kraken_fee_tiers = [
+    (0, 0.0016, 0.0026),
+    (50_000, 0.0014, 0.0024),
+    (100_000, 0.0012, 0.0022),
+    (250_000, 0.0010, 0.0020),
+    (500_000, 0.0008, 0.0018),
+    (1_000_000, 0.0006, 0.0016),
+    (2_500_000, 0.0004, 0.0014),
+    (5_000_000, 0.0002, 0.0012),
+    (10_000_000, 0.0, 0.0010),
+]
+
+volume_window = pd.Timedelta(days=30)
+
+
+class FeeSchedule(object):
+    # volume tiered maker / taker fee rates
+    def __init__(
+        self,
+        tiers=kraken_fee_tiers,
+    ) -> None:
+        tiers = sorted(tiers)
+        self.thresholds = np.array([tier[0] for tier in tiers], dtype=float)
+        self.maker_rates = np.array([tier[1] for tier in tiers])
+        self.taker_rates = np.array([tier[2] for tier in tiers])
+
+    @classmethod
+    def flat(cls, fee_rate=0.0026):
+        return(cls(tiers=[(0, fee_rate, fee_rate)]))
+
+    def rates(self, volumes_30d, maker=False):
+        tiers = np.searchsorted(
+            self.thresholds,
+            np.asarray(volumes_30d, dtype=float),
+            side='right',
+        ) - 1
+        tiers = np.maximum(tiers, 0)
+        return(
+            np.where(maker, self.maker_rates[tiers], self.taker_rates[tiers])
+        )
+
+
+def _seconds(timestamps):
+    # epoch seconds from numbers, datetimes or datetime64 arrays
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == 'M':
+        return(timestamps.astype('datetime64[s]').astype(np.int64))
+    if timestamps.dtype.kind == 'O':
+        return(pd.to_datetime(timestamps).to_numpy().astype(
+            'datetime64[s]').astype(np.int64))
+    return(timestamps.astype(np.int64))
+
+
+def _datetimes(timestamps, timezone=None):
+    # DatetimeIndex from datetimes or epoch seconds. Epoch seconds become
+    # naive local datetimes, as the `dt.datetime.fromtimestamp` datetimes of
+    # `get_ohlc`, or datetimes in `timezone` for timezone aware indexes.
+    timestamps = np.atleast_1d(timestamps)
+    if timestamps.dtype.kind not in 'iuf':
+        return(pd.DatetimeIndex(pd.to_datetime(timestamps)))
+    datetimes = pd.to_datetime(timestamps, unit='s', utc=True)
+    if timezone is not None:
+        return(datetimes.tz_convert(timezone))
+    return(datetimes.tz_convert(tz.tzlocal()).tz_localize(None))
+
+
+def rolling_volume(
+    timestamps,
+    notionals,
+    window=volume_window,
+    groups=None,
+    prior_volume=0.,
+):
+    # volume traded in `window` before each fill (the fill excluded).
+    # Fills of different `groups` (e.g. simulated paths) do not share their
+    # volume. Fills must be sorted by time within each group.
+    seconds = _seconds(timestamps)
+    notionals = np.asarray(notionals, dtype=float)
+    window = int(pd.Timedelta(window).total_seconds())
+    if len(seconds) == 0:
+        return(np.zeros(0))
+    keys = seconds - seconds.min()
+    if groups is not None:
+        # groups are laid out far enough apart that windows never overlap
+        groups = np.asarray(groups, dtype=np.int64)
+        order = np.lexsort((keys, groups))
+        keys = keys[order] + groups[order] * (keys.max() + window + 1)
+        notionals = notionals[order]
+    cumulated = np.zeros(len(notionals) + 1)
+    np.cumsum(notionals, out=cumulated[1:])
+    window_starts = np.searchsorted(keys, keys - window, side='left')
+    volumes = (
+        cumulated[np.arange(len(notionals))] - cumulated[window_starts]
+        + prior_volume
+    )
+    if groups is not None:
+        unsorted = np.empty_like(volumes)
+        unsorted[order] = volumes
+        volumes = unsorted
+    return(volumes)
+
+
+def corwin_schultz_spread(high, low):
+    # relative bid-ask spread estimated from the high / low of two
+    # consecutive bars (Corwin & Schultz, 2012), using the bar and the
+    # previous one so that no future data is used. First bar is NaN.
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    spreads = np.full(len(high), np.nan)
+    if len(high) < 2:
+        return(spreads)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ranges = np.log(high / low) ** 2
+        beta = log_ranges[1:] + log_ranges[:-1]
+        gamma = np.log(
+            np.maximum(high[1:], high[:-1]) / np.minimum(low[1:], low[:-1])
+        ) ** 2
+        k = 3 - 2 * np.sqrt(2)
+        alpha = (
+            (np.sqrt(2 * beta) - np.sqrt(beta)) / k - np.sqrt(gamma / k)
+        )
+        spreads[1:] = np.maximum(
+            2 * (np.exp(alpha) - 1) / (1 + np.exp(alpha)),
+            0.,
+        )
+    return(spreads)
+
+
+def estimate_spreads(ohlc, window=30):
+    # rolling mean of the Corwin-Schultz estimate on an OHLC DataFrame (as
+    # returned by `get_ohlc`), indexed by datetime when available
+    spreads = pd.Series(
+        corwin_schultz_spread(ohlc['high'], ohlc['low']),
+        index=ohlc['datetime'] if 'datetime' in ohlc else ohlc.index,
+    )
+    return(spreads.rolling(window, min_periods=1).mean())
+
+
+class ExecutionModel(object):
+    # fees, spread and slippage of market or limit fills
+    def __init__(
+        self,
+        fee_schedule=None,
+        min_order_sizes=None,
+        spreads=None,
+        default_spread=0.,
+        slippage_rate=0.,
+        maker=False,
+        window=volume_window,
+        prior_volume=0.,
+    ) -> None:
+        # min_order_sizes: pair -> minimum base volume of an order
+        # spreads: pair -> relative spread Series indexed by datetime (see
+        # `estimate_spreads`), `default_spread` is used for other pairs
+        self.fee_schedule = fee_schedule or FeeSchedule()
+        self.min_order_sizes = {
+            self._pair_key(pair): size
+            for pair, size in (min_order_sizes or {}).items()
+        }
+        self.spreads = {
+            self._pair_key(pair): spread
+            for pair, spread in (spreads or {}).items()
+        }
+        self.default_spread = default_spread
+        self.slippage_rate = slippage_rate
+        self.maker = maker
+        self.window = pd.Timedelta(window)
+        self.prior_volume = prior_volume
+
+    @classmethod
+    def flat(cls, fee_rate=0.0026):
+        return(cls(fee_schedule=FeeSchedule.flat(fee_rate)))
+
+    @staticmethod
+    def _pair_key(pair):
+        # pair id, or the name itself for pairs unknown to the registry
+        return(get_registry().pair_id(pair, default=pair))
+
+    def min_order_size(self, pairs):
+        if np.ndim(pairs) == 0:
+            return(self.min_order_sizes.get(self._pair_key(pairs), 0.))
+        if not self.min_order_sizes:
+            return(np.zeros(np.shape(pairs)))
+        # each distinct pair is resolved once
+        inverse, names = pd.factorize(np.ravel(pairs))
+        return(
+            np.array([self.min_order_size(name) for name in names])[
+                inverse
+            ].reshape(np.shape(pairs))
+        )
+
+    def spread_at(self, pair, datetimes):
+        # spread of `pair` in effect at each of `datetimes` (datetimes or
+        # epoch seconds), the default one before its first estimate
+        pair = self._pair_key(pair)
+        if pair not in self.spreads:
+            return(np.full(np.shape(datetimes), self.default_spread))
+        spreads = self.spreads[pair]
+        positions = spreads.index.searchsorted(
+            _datetimes(np.ravel(datetimes), timezone=spreads.index.tz),
+            side='right',
+        ) - 1
+        values = np.where(
+            positions >= 0,
+            spreads.to_numpy()[np.maximum(positions, 0)],
+            self.default_spread,
+        )
+        values = np.where(np.isnan(values), self.default_spread, values)
+        return(values.reshape(np.shape(datetimes)))
+
+    def spreads_at(self, pairs, datetimes):
+        # spreads of fills of several pairs, looked up once per distinct pair
+        if np.ndim(pairs) == 0:
+            return(self.spread_at(pairs, datetimes))
+        datetimes = np.atleast_1d(datetimes)
+        spreads = np.full(len(datetimes), float(self.default_spread))
+        if not self.spreads:
+            return(spreads)
+        inverse, names = pd.factorize(np.ravel(pairs))
+        for k, name in enumerate(names):
+            fills = inverse == k
+            spreads[fills] = self.spread_at(name, datetimes[fills])
+        return(spreads)
+
+    @profiled
+    def costs(
+        self,
+        timestamps,
+        volumes,
+        prices,
+        pairs=None,
+        spreads=None,
+        quote_rates=1.,
+        maker=None,
+        groups=None,
+        prior_volume=None,
+        prior_fills=None,
+    ):
+        # prices the fills of base `volumes` traded at `prices` (quote
+        # currency). Returns a dict of arrays; fills below the minimum order
+        # size of their pair are not executed and cost nothing.
+        # `prior_fills` are (epoch seconds, notionals) of earlier executed
+        # fills counted in the 30 days volume, e.g. `VirtualPortfolio.fills`.
+        volumes = np.abs(np.asarray(volumes, dtype=float))
+        prices = np.asarray(prices, dtype=float)
+        quote_rates = np.asarray(quote_rates, dtype=float)
+        maker = self.maker if maker is None else np.asarray(maker)
+        timestamps = np.atleast_1d(timestamps)
+        if spreads is None:
+            spreads = self.spreads_at(pairs, timestamps)
+        executed = volumes >= self.min_order_size(pairs)
+        notionals = np.where(executed, volumes * prices * quote_rates, 0.)
+        volumes_30d = self._volumes_30d(
+            _seconds(timestamps),
+            notionals,
+            groups=groups,
+            prior_volume=(
+                self.prior_volume if prior_volume is None else prior_volume
+            ),
+            prior_fills=prior_fills,
+        )
+        fee_rates = self.fee_schedule.rates(volumes_30d, maker=maker)
+        fees = notionals * fee_rates
+        # takers cross half the spread, makers are filled at their price
+        slippage = notionals * (
+            np.where(maker, 0., np.asarray(spreads, dtype=float) / 2)
+            + self.slippage_rate
+        )
+        return({
+            'executed': executed,
+            'notional': notionals,
+            'volume_30d': volumes_30d,
+            'fee_rate': fee_rates,
+            'fees': fees,
+            'slippage': slippage,
+            'total': fees + slippage,
+        })
+
+    def _volumes_30d(
+        self,
+        seconds,
+        notionals,
+        groups=None,
+        prior_volume=0.,
+        prior_fills=None,
+    ):
+        if prior_fills is None or len(prior_fills[0]) == 0:
+            return(
+                rolling_volume(
+                    seconds,
+                    notionals,
+                    window=self.window,
+                    groups=groups,
+                    prior_volume=prior_volume,
+                )
+            )
+        if groups is not None:
+            raise ValueError('prior_fills can not be used with groups')
+        # prior fills come first among fills of the same second
+        prior_seconds = _seconds(prior_fills[0])
+        all_seconds = np.concatenate([prior_seconds, seconds])
+        order = np.argsort(all_seconds, kind='stable')
+        volumes = np.empty(len(all_seconds))
+        volumes[order] = rolling_volume(
+            all_seconds[order],
+            np.concatenate([
+                np.asarray(prior_fills[1], dtype=float),
+                notionals,
+            ])[order],
+            window=self.window,
+            prior_volume=prior_volume,
+        )
+        return(volumes[len(prior_seconds):])
+
+    def trade_costs(
+        self,
+        datetime,
+        volume,
+        price,
+        pair=None,
+        quote_rate=1.,
+        maker=None,
+        prior_fills=None,
+    ):
+        # prices one fill, `prior_fills` as in `costs`
+        costs = self.costs(
+            [int(_seconds([datetime])[0])],
+            [volume],
+            [price],
+            pairs=pair,
+            spreads=self.spread_at(pair, [datetime]),
+            quote_rates=quote_rate,
+            maker=maker,
+            prior_fills=prior_fills,
+        )
+        return({key: value[0].item() for key, value in costs.items()})
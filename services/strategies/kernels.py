@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from itertools import product
+
+from services.profiling.profiler import profiled
+
+
+# Vectorized moving average crossover kernels.
+#
+# Prices are 2D arrays of shape (bars, pairs). Rolling means for every
+# requested window are computed at once from a single cumulative sum, and
+# crossovers are detected for every (short window, long window, pair)
+# combination without any python loop over bars or signals. Semantics are
+# those of `CrossAverageStrategy.generate_signals`: a bar is "above" when the
+# short mean is above the long mean by more than a relative tie tolerance
+# (`is_above`, shared with `generate_signals`; equal or NaN means are never
+# above), a buy is emitted when a bar is above and the previous one is not,
+# a sell in the opposite case.
+
+CrossoverEvents = namedtuple(
+    'CrossoverEvents',
+    [
+        'combo',      # index in `windows`
+        'pair',       # column index in the price matrix
+        'bar',        # row index in the price matrix
+        'direction',  # 1 for buy, -1 for sell
+        'windows',    # (n_combos, 2) array of (short, long) windows
+    ],
+)
+
+
+def window_combinations(short_windows, long_windows):
+    return(
+        np.array(
+            list(product(
+                np.atleast_1d(short_windows),
+                np.atleast_1d(long_windows),
+            )),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+    )
+
+
+def rolling_means(prices, windows, block_size=4096):
+    # returns an array of shape (windows, bars, pairs), NaN where the window
+    # is not full or contains a missing price, as pandas rolling().mean().
+    # Sums are differences of cumulative sums restarted every `block_size`
+    # bars and centered on the block, which bounds their rounding error
+    # whatever the length of the history. Windows of identical prices
+    # (flat runs of quoted or forward filled prices) get that price
+    # exactly, as in pandas, so that equal means compare equal.
+    prices = np.asarray(prices, dtype=np.float64)
+    if prices.ndim == 1:
+        prices = prices[:, None]
+    windows = np.atleast_1d(np.asarray(windows, dtype=np.int64))
+    if (windows < 1).any():
+        raise ValueError(f'Unexpected window: {windows[windows < 1][0]}')
+    n_bars, n_pairs = prices.shape
+    valid = ~np.isnan(prices)
+    means = np.full((len(windows), n_bars, n_pairs), np.nan)
+    max_window = int(windows.max(initial=1))
+    block_size = max(block_size, max_window)
+    for start in range(0, n_bars, block_size):
+        stop = min(start + block_size, n_bars)
+        first = max(start - max_window + 1, 0)
+        block_valid = valid[first:stop]
+        filled = np.where(block_valid, prices[first:stop], 0.)
+        center = filled.sum(axis=0) / np.maximum(block_valid.sum(axis=0), 1)
+        cumsum = np.zeros((stop - first + 1, n_pairs))
+        np.cumsum(
+            np.where(block_valid, filled - center, 0.),
+            axis=0,
+            out=cumsum[1:],
+        )
+        counts = np.zeros((stop - first + 1, n_pairs), dtype=np.int64)
+        np.cumsum(block_valid, axis=0, out=counts[1:])
+        for k, window in enumerate(windows):
+            # bars [low, stop[ ending a full window, as cumsum positions
+            low = max(start, window - 1)
+            if low >= stop:
+                continue
+            ends = slice(low - first + 1, stop - first + 1)
+            begins = slice(low - first + 1 - window, stop - first + 1 - window)
+            full = (counts[ends] - counts[begins]) == window
+            means[k, low:stop] = np.where(
+                full,
+                (cumsum[ends] - cumsum[begins]) / window + center,
+                np.nan,
+            )
+
+    # length of the run of identical prices ending at each bar
+    bars = np.arange(n_bars)[:, None]
+    changed = np.ones((n_bars, n_pairs), dtype=bool)
+    changed[1:] = prices[1:] != prices[:-1]
+    run_lengths = bars - np.maximum.accumulate(
+        np.where(changed, bars, 0),
+        axis=0,
+    ) + 1
+    for k, window in enumerate(windows):
+        flat = valid & (run_lengths >= window)
+        means[k][flat] = prices[flat]
+    return(means)
+
+
+# relative difference under which a short and a long mean are tied: well
+# above the rounding error of the means, and below the difference of means
+# which are not equal for prices quoted to 5 significant digits (at least
+# 1e-5 / (short window * long window) relatively)
+tie_rtol = 1e3 * np.finfo(np.float64).eps
+
+
+def is_above(short_means, long_means, out=None):
+    # True where the short mean is above the long mean by more than the
+    # tie tolerance, False on ties and NaN. Works on arrays and Series.
+    with np.errstate(invalid='ignore'):
+        return(
+            np.greater(
+                short_means - long_means,
+                tie_rtol * np.abs(long_means),
+                out=out,
+            )
+        )
+
+
+@profiled
+def crossover_events(
+    prices,
+    short_windows,
+    long_windows,
+    chunk_size=32,
+    pair_chunk_size=8,
+):
+    # every combination of short and long windows is evaluated on every
+    # column of `prices`. Columns are processed `pair_chunk_size` at a time,
+    # which bounds the rolling means to (windows, bars, pair_chunk_size)
+    # floats, and combinations `chunk_size` at a time, which bounds the
+    # boolean (combos, pairs, bars) array. Events are ordered by combination,
+    # pair then bar.
+    prices = np.asarray(prices, dtype=np.float64)
+    if prices.ndim == 1:
+        prices = prices[:, None]
+    n_bars, n_pairs = prices.shape
+    windows = window_combinations(short_windows, long_windows)
+    unique_windows, inverse = np.unique(windows, return_inverse=True)
+    inverse = inverse.reshape(windows.shape)
+
+    combos, pairs, bars, directions = [], [], [], []
+    for first_pair in range(0, n_pairs, pair_chunk_size):
+        last_pair = min(first_pair + pair_chunk_size, n_pairs)
+        # (windows, pairs, bars) so that events come out ordered by pair
+        # then bar within a combination
+        means = rolling_means(
+            prices[:, first_pair:last_pair],
+            unique_windows,
+        ).transpose(0, 2, 1)
+        above = np.empty(
+            (min(chunk_size, len(windows)), last_pair - first_pair, n_bars),
+            dtype=bool,
+        )
+        for start in range(0, len(windows), chunk_size):
+            stop = min(start + chunk_size, len(windows))
+            for k, (short, long) in enumerate(inverse[start:stop]):
+                is_above(means[short], means[long], out=above[k])
+            chunk = above[:stop - start]
+            combo, pair, bar = np.nonzero(
+                chunk[:, :, 1:] != chunk[:, :, :-1]
+            )
+            bar += 1
+            combos.append(combo + start)
+            pairs.append(pair + first_pair)
+            bars.append(bar)
+            directions.append(
+                np.where(chunk[combo, pair, bar], 1, -1).astype(np.int8)
+            )
+
+    def concat(arrays, dtype):
+        if not arrays:
+            return(np.empty(0, dtype=dtype))
+        return(np.concatenate(arrays).astype(dtype, copy=False))
+
+    combo = concat(combos, np.int64)
+    pair = concat(pairs, np.int64)
+    bar = concat(bars, np.int64)
+    direction = concat(directions, np.int8)
+    if n_pairs > pair_chunk_size:
+        order = np.lexsort((bar, pair, combo))
+        combo, pair, bar, direction = (
+            combo[order], pair[order], bar[order], direction[order]
+        )
+    return(
+        CrossoverEvents(
+            combo=combo,
+            pair=pair,
+            bar=bar,
+            direction=direction,
+            windows=windows,
+        )
+    )
+
+
+def held_state(prices, short_window, long_window):
+    # (bars, pairs) boolean array, True where the strategy holds the base
+    # asset after the trades of the bar: from the first buy signal, while the
+    # short mean is above the long mean (leading sells are ignored, as in
+    # `CrossAverageStrategy.evaluate`)
+    short_mv, long_mv = rolling_means(prices, [short_window, long_window])
+    above = is_above(short_mv, long_mv)
+    buys = np.zeros_like(above)
+    buys[1:] = above[1:] & ~above[:-1]
+    return(above & np.logical_or.accumulate(buys, axis=0))
+
+
+def screen_crossovers(
+    price_history,
+    short_windows,
+    long_windows,
+    chunk_size=32,
+):
+    # runs `crossover_events` over every column of a price history
+    # DataFrame (one column per trading pair, as used by the strategies) and
+    # returns one row per signal
+    events = crossover_events(
+        price_history.to_numpy(dtype=np.float64),
+        short_windows,
+        long_windows,
+        chunk_size=chunk_size,
+    )
+    return(
+        pd.DataFrame({
+            'trading_pair': price_history.columns.to_numpy()[events.pair],
+            'short_window': events.windows[events.combo, 0],
+            'long_window': events.windows[events.combo, 1],
+            'datetime': price_history.index.to_numpy()[events.bar],
+            'signal_type': np.where(events.direction > 0, 'buy', 'sell'),
+        })
+    )
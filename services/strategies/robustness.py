@@ -0,0 +1,304 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from services.profiling.profiler import profiled
+from services.strategies.kernels import held_state
+
+
+# Monte Carlo / bootstrap robustness of the cross average strategy.
+#
+# Synthetic price paths with the length of the historical one are generated
+# from its log returns, either by block bootstrap (blocks of consecutive
+# returns drawn with replacement, which keeps short term autocorrelation and
+# volatility clustering) or as a gaussian random walk with the historical
+# drift and volatility. Paths are generated chunk by chunk inside the worker
+# processes, so memory is bounded by about
+# `chunk_size * n_bars * 40 bytes` per worker whatever `n_paths` is.
+#
+# Each chunk is evaluated with array operations only: the strategy holds the
+# base asset from the first buy signal while the short mean is above the long
+# mean, and trades the whole portfolio at the close of signal bars, as
+# `CrossAverageStrategy.evaluate` does. Fees are `fee_rate` times the traded
+# value, or the costs of an `ExecutionModel`, and are reported separately,
+# as in `VirtualPortfolio`. As there, fills below the minimum order size of
+# the model raise a ValueError.
+
+methods = ('block_bootstrap', 'random_walk')
+
+metrics = [
+    'return_ratio',
+    'annualized_return_ratio',
+    'total_fees',
+    'net_return_ratio',
+    'net_annualized_return_ratio',
+]
+
+
+def log_returns(prices):
+    prices = np.asarray(prices, dtype=np.float64)
+    returns = np.diff(np.log(prices))
+    return(returns[~np.isnan(returns)])
+
+
+def block_bootstrap_paths(
+    returns,
+    n_paths,
+    n_bars,
+    initial_price,
+    block_size=60,
+    rng=None,
+):
+    # (n_paths, n_bars) prices made of blocks of consecutive returns
+    if rng is None:
+        rng = np.random.default_rng()
+    block_size = int(min(block_size, len(returns)))
+    n_blocks = -(-(n_bars - 1) // block_size)
+    starts = rng.integers(
+        0,
+        len(returns) - block_size + 1,
+        size=(n_paths, n_blocks),
+    )
+    indices = (
+        starts[:, :, None] + np.arange(block_size)
+    ).reshape(n_paths, -1)[:, :n_bars - 1]
+    return(_prices_from_returns(returns[indices], initial_price))
+
+
+def random_walk_paths(
+    drift,
+    volatility,
+    n_paths,
+    n_bars,
+    initial_price,
+    rng=None,
+):
+    # (n_paths, n_bars) prices following a gaussian random walk of log prices
+    if rng is None:
+        rng = np.random.default_rng()
+    returns = rng.normal(drift, volatility, size=(n_paths, n_bars - 1))
+    return(_prices_from_returns(returns, initial_price))
+
+
+def _prices_from_returns(returns, initial_price):
+    log_prices = np.zeros((returns.shape[0], returns.shape[1] + 1))
+    np.cumsum(returns, axis=1, out=log_prices[:, 1:])
+    return(initial_price * np.exp(log_prices))
+
+
+def generate_paths(
+    prices,
+    n_paths,
+    method='block_bootstrap',
+    block_size=60,
+    rng=None,
+):
+    prices = np.asarray(prices, dtype=np.float64)
+    returns = log_returns(prices)
+    initial_price = prices[~np.isnan(prices)][0]
+    if method == 'block_bootstrap':
+        return(
+            block_bootstrap_paths(
+                returns,
+                n_paths,
+                len(prices),
+                initial_price,
+                block_size=block_size,
+                rng=rng,
+            )
+        )
+    elif method == 'random_walk':
+        return(
+            random_walk_paths(
+                returns.mean(),
+                returns.std(),
+                n_paths,
+                len(prices),
+                initial_price,
+                rng=rng,
+            )
+        )
+    raise ValueError(f'Unexpected method: {method}')
+
+
+@profiled
+def evaluate_paths(
+    paths,
+    short_window,
+    long_window,
+    years_per_period,
+    fee_rate=0.0026,
+    initial_value=1000.,
+    execution_model=None,
+    bar_seconds=60,
+    pair=None,
+    start_seconds=0.,
+):
+    # evaluates the strategy on every row of `paths` (n_paths, n_bars) and
+    # returns the metrics of `VirtualPortfolio.eval_performance` as arrays.
+    # `years_per_period` is the duration of the whole path in years. With an
+    # `execution_model`, costs of all fills of the chunk are priced at once
+    # instead of using the flat `fee_rate`; bar `i` of every path is dated
+    # `start_seconds + i * bar_seconds` (epoch seconds) for the spread and
+    # volume lookups.
+    prices = np.asarray(paths, dtype=np.float64).T
+    held = held_state(prices, short_window, long_window)
+
+    growth = np.ones_like(prices)
+    growth[1:] = np.where(held[:-1], prices[1:] / prices[:-1], 1.)
+    values = initial_value * np.cumprod(growth, axis=0)
+    trades = np.zeros_like(held)
+    trades[1:] = held[1:] != held[:-1]
+    if execution_model is None:
+        total_fees = fee_rate * np.where(trades, values, 0.).sum(axis=0)
+    else:
+        # fills below the minimum order size are rejected, as by
+        # `VirtualPortfolio.apply_trades` on the same path
+        bars, path_ids = np.nonzero(trades)
+        costs = execution_model.costs(
+            start_seconds + bars * bar_seconds,
+            values[bars, path_ids] / prices[bars, path_ids],
+            prices[bars, path_ids],
+            pairs=pair,
+            groups=path_ids,
+        )
+        if not costs['executed'].all():
+            position = np.flatnonzero(~costs['executed'])[0]
+            bar, path_id = bars[position], path_ids[position]
+            raise ValueError(
+                f'Volume {values[bar, path_id] / prices[bar, path_id]} at '
+                f'bar {bar} of path {path_id} is below the minimum order size'
+            )
+        total_fees = np.bincount(
+            path_ids,
+            weights=costs['total'],
+            minlength=prices.shape[1],
+        )
+
+    return_ratio = values[-1] / initial_value - 1
+    net_return_ratio = (values[-1] - total_fees) / initial_value - 1
+    return({
+        'return_ratio': return_ratio,
+        'annualized_return_ratio': (
+            (1 + return_ratio) ** (1 / years_per_period) - 1
+        ),
+        'total_fees': total_fees,
+        'net_return_ratio': net_return_ratio,
+        'net_annualized_return_ratio': (
+            (1 + net_return_ratio) ** (1 / years_per_period) - 1
+        ),
+    })
+
+
+# per worker process state, set once by the pool initializer instead of
+# pickling the price history with every chunk
+_worker_state = {}
+
+
+def _init_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+
+def _evaluate_chunk(task):
+    seed, n_paths = task
+    state = _worker_state
+    paths = generate_paths(
+        state['prices'],
+        n_paths,
+        method=state['method'],
+        block_size=state['block_size'],
+        rng=np.random.default_rng(seed),
+    )
+    return(
+        evaluate_paths(
+            paths,
+            state['short_window'],
+            state['long_window'],
+            state['years_per_period'],
+            fee_rate=state['fee_rate'],
+            initial_value=state['initial_value'],
+            execution_model=state['execution_model'],
+            bar_seconds=state['bar_seconds'],
+            pair=state['pair'],
+            start_seconds=state['start_seconds'],
+        )
+    )
+
+
+@profiled
+def run_robustness(
+    strategy,
+    price_history,
+    n_paths=1000,
+    method='block_bootstrap',
+    block_size=60,
+    chunk_size=32,
+    n_workers=None,
+    seed=None,
+    fee_rate=0.0026,
+    initial_value=1000.,
+    execution_model=None,
+):
+    # returns a DataFrame with one row of metrics per synthetic path.
+    # n_workers=1 runs in process, None uses one process per cpu.
+    if method not in methods:
+        raise ValueError(f'Unexpected method: {method}')
+    price_series = price_history.loc[:, strategy.pair_column(price_history)]
+    test_duration = price_series.index.max() - price_series.index.min()
+    state = {
+        'prices': price_series.to_numpy(dtype=np.float64),
+        'method': method,
+        'block_size': block_size,
+        'short_window': strategy.short_window,
+        'long_window': strategy.long_window,
+        'years_per_period': test_duration / pd.Timedelta(days=365),
+        'fee_rate': fee_rate,
+        'initial_value': initial_value,
+        'execution_model': execution_model,
+        'bar_seconds': (
+            test_duration.total_seconds() / max(len(price_series) - 1, 1)
+        ),
+        'pair': strategy.trading_pair,
+        # paths follow the calendar of the price history
+        'start_seconds': (
+            price_series.index.min().to_pydatetime().timestamp()
+        ),
+    }
+    chunk_sizes = [
+        min(chunk_size, n_paths - start)
+        for start in range(0, n_paths, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    tasks = list(zip(seeds, chunk_sizes))
+
+    if n_workers == 1:
+        _init_worker(state)
+        results = [_evaluate_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(state,),
+        ) as executor:
+            results = list(executor.map(_evaluate_chunk, tasks))
+
+    return(
+        pd.DataFrame({
+            metric: np.concatenate([result[metric] for result in results])
+            for metric in metrics
+        })
+    )
+
+
+def summarize(
+    results,
+    quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+):
+    # distribution of each metric over the synthetic paths
+    summary = results.quantile(list(quantiles)).T
+    summary.columns = [f'q{q:.0%}' for q in quantiles]
+    summary.insert(0, 'std', results.std())
+    summary.insert(0, 'mean', results.mean())
+    summary['prob_positive'] = (results > 0).mean()
+    return(summary)
@@ -0,0 +1,208 @@
+import numpy as np
+
+from services.profiling.profiler import profiled
+from services.strategies.kernels import rolling_means
+
+
+# Position sizing and rebalancing with array operations.
+#
+# Strategies give an exposure state per bar and asset (1 when the asset
+# should be held, 0 otherwise). Sizers turn it into target portfolio weights
+# (fraction of the portfolio value held in each asset, the rest in the quote
+# asset), and `rebalance` computes the holdings and trades realizing these
+# targets over the whole horizon at once. The portfolio trades at the close
+# of the bars where target weights change, holdings are constant in between.
+# Volatility based sizers therefore only resize on signal bars (where the
+# state of an asset changes) by default, otherwise their targets move and
+# the portfolio trades on every bar.
+#
+# As in `VirtualPortfolio`, fees are not deducted from the holdings; they are
+# computed from the trades and reported separately.
+
+year_seconds = 365 * 24 * 3600
+
+
+def _hold_between_signals(weights, state):
+    # weights of the last bar where the state of any asset changed
+    signals = np.ones(len(state), dtype=bool)
+    signals[1:] = (state[1:] != state[:-1]).any(axis=1)
+    last_signal = np.maximum.accumulate(
+        np.where(signals, np.arange(len(state)), 0)
+    )
+    return(weights[last_signal])
+
+
+def _rolling_volatility(prices, lookback, bar_seconds):
+    # annualized volatility of log returns over `lookback` bars, using data
+    # up to and including each bar (no look ahead)
+    prices = np.asarray(prices, dtype=np.float64)
+    returns = np.full_like(prices, np.nan)
+    returns[1:] = np.diff(np.log(prices), axis=0)
+    means, square_means = rolling_means(
+        np.concatenate([returns, returns ** 2], axis=1),
+        [lookback],
+    )[0].reshape(len(prices), 2, -1).transpose(1, 0, 2)
+    variance = np.maximum(square_means - means ** 2, 0.) * (
+        lookback / max(lookback - 1, 1)
+    )
+    return(np.sqrt(variance * year_seconds / bar_seconds))
+
+
+class FixedFraction(object):
+    # invests `fraction` of the portfolio, split equally among held assets
+    def __init__(
+        self,
+        fraction=1.,
+    ) -> None:
+        self.fraction = fraction
+
+    def target_weights(self, state, prices=None, bar_seconds=60):
+        state = np.asarray(state, dtype=np.float64)
+        held = state.sum(axis=1, keepdims=True)
+        return(self.fraction * state / np.maximum(held, 1.))
+
+
+class VolatilityTarget(object):
+    # sizes each held asset so that its annualized volatility contribution is
+    # `target_volatility`, scaled down when the total exceeds `max_leverage`.
+    # With resize='signal' weights are set on signal bars and kept until the
+    # next one, resize='bar' follows the volatility on every bar.
+    def __init__(
+        self,
+        target_volatility=0.5,
+        lookback=1440,
+        max_weight=1.,
+        max_leverage=1.,
+        resize='signal',
+    ) -> None:
+        if resize not in ('signal', 'bar'):
+            raise ValueError(f'Unexpected resize: {resize}')
+        self.target_volatility = target_volatility
+        self.lookback = lookback
+        self.max_weight = max_weight
+        self.max_leverage = max_leverage
+        self.resize = resize
+
+    def target_weights(self, state, prices=None, bar_seconds=60):
+        state = np.asarray(state, dtype=np.float64)
+        volatility = _rolling_volatility(prices, self.lookback, bar_seconds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(
+                (state > 0) & (volatility > 0),
+                state * self.target_volatility / volatility,
+                0.,
+            )
+        weights = _cap_leverage(
+            np.minimum(weights, self.max_weight),
+            self.max_leverage,
+        )
+        if self.resize == 'signal':
+            weights = _hold_between_signals(weights, state)
+        return(weights)
+
+
+class EqualRisk(object):
+    # splits `fraction` of the portfolio among held assets in inverse
+    # proportion to their volatility, so that each contributes the same risk
+    # (resize as in `VolatilityTarget`)
+    def __init__(
+        self,
+        fraction=1.,
+        lookback=1440,
+        resize='signal',
+    ) -> None:
+        if resize not in ('signal', 'bar'):
+            raise ValueError(f'Unexpected resize: {resize}')
+        self.fraction = fraction
+        self.lookback = lookback
+        self.resize = resize
+
+    def target_weights(self, state, prices=None, bar_seconds=60):
+        state = np.asarray(state, dtype=np.float64)
+        volatility = _rolling_volatility(prices, self.lookback, bar_seconds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = np.where(
+                (state > 0) & (volatility > 0),
+                state / volatility,
+                0.,
+            )
+        total = inverse.sum(axis=1, keepdims=True)
+        weights = self.fraction * inverse / np.where(total > 0, total, 1.)
+        if self.resize == 'signal':
+            weights = _hold_between_signals(weights, state)
+        return(weights)
+
+
+def _cap_leverage(weights, max_leverage):
+    gross = np.abs(weights).sum(axis=1, keepdims=True)
+    return(weights * np.minimum(1., max_leverage / np.maximum(gross, 1e-300)))
+
+
+@profiled
+def rebalance(
+    prices,
+    weights,
+    initial_value,
+    initial_units=None,
+):
+    # holdings realizing target `weights` (bars, assets) at `prices` (quote
+    # asset per unit), starting from `initial_value` in quote asset and
+    # `initial_units` (assets,) held, which are kept until the first change
+    # of the targets. Returns the units held after each bar (bars, assets),
+    # the quote asset balance (bars,) and the traded units (bars, assets),
+    # non zero on rebalancing bars only.
+    prices = np.asarray(prices, dtype=np.float64)
+    weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+    n_bars, n_assets = weights.shape
+    if initial_units is None:
+        initial_units = np.zeros(n_assets)
+    initial_units = np.asarray(initial_units, dtype=np.float64)
+    changes = np.zeros(n_bars, dtype=bool)
+    changes[0] = weights[0].any()
+    changes[1:] = (weights[1:] != weights[:-1]).any(axis=1)
+    events = np.flatnonzero(changes)
+
+    units = np.tile(initial_units, (n_bars, 1))
+    cash = np.full(n_bars, float(initial_value))
+    trades = np.zeros((n_bars, n_assets))
+    if len(events) == 0:
+        return(units, cash, trades)
+
+    event_prices = prices[events]
+    event_weights = weights[events]
+    # value growth between consecutive rebalancing bars, assets with a zero
+    # weight do not contribute even when their price is missing
+    relatives = np.ones_like(event_prices)
+    relatives[1:] = event_prices[1:] / event_prices[:-1]
+    previous_weights = np.zeros_like(event_weights)
+    previous_weights[1:] = event_weights[:-1]
+    growth = (
+        np.where(previous_weights != 0, previous_weights * relatives, 0.)
+        .sum(axis=1)
+        + 1 - previous_weights.sum(axis=1)
+    )
+    # value of the initial holdings at the first rebalancing bar
+    first_value = initial_value + np.where(
+        initial_units != 0,
+        initial_units * event_prices[0],
+        0.,
+    ).sum()
+    values = first_value * np.cumprod(growth)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        event_units = np.where(
+            event_weights != 0,
+            event_weights * values[:, None] / event_prices,
+            0.,
+        )
+    event_cash = values * (1 - event_weights.sum(axis=1))
+
+    # holdings are those of the last rebalancing bar
+    last_event = np.maximum.accumulate(
+        np.where(changes, np.arange(n_bars), -1)
+    )
+    event_number = np.cumsum(changes) - 1
+    rebalanced = last_event >= 0
+    units[rebalanced] = event_units[event_number[rebalanced]]
+    cash[rebalanced] = event_cash[event_number[rebalanced]]
+    trades[events] = np.diff(event_units, axis=0, prepend=initial_units[None])
+    return(units, cash, trades)
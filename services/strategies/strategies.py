@@ -1,8 +1,31 @@
+import numpy as np
 import pandas as pd
 import datetime as dt
-import matplotlib.pyplot as plt
 from typing import List
 
+from services.hist_data.registry import get_registry
+from services.profiling.profiler import profiled
+from services.strategies.execution import ExecutionModel
+from services.strategies.kernels import held_state, is_above
+from services.strategies.sizing import FixedFraction, rebalance
+from services.viz.plotting import plot_signals
+
+
+def _rates_at(quote_rate, datetimes):
+    # quote rates at `datetimes`, from a constant rate or from a Series of
+    # rates indexed by datetime (last rate known at each datetime)
+    if not isinstance(quote_rate, pd.Series):
+        return(np.full(len(datetimes), float(quote_rate)))
+    rates = quote_rate.sort_index().reindex(
+        datetimes,
+        method='ffill',
+    ).to_numpy(dtype=float)
+    if np.isnan(rates).any():
+        raise ValueError(
+            f'No quote rate at {pd.Index(datetimes)[np.isnan(rates)][0]}'
+        )
+    return(rates)
+
 
 class Signal(object):
     # represents a buy or sell signal
@@ -14,6 +37,7 @@ class Signal(object):
         datetime=None,
         volume=None,
         price=None,
+        pair_id=None,
     ) -> None:
         self.base_asset = base_asset
         self.quote_asset = quote_asset
@@ -21,6 +45,7 @@ class Signal(object):
         self.datetime = datetime
         self.volume = volume
         self.price = price
+        self.pair_id = pair_id
 
 
 class VirtualPortfolio(object):
@@ -30,7 +55,10 @@ class VirtualPortfolio(object):
         initial_volumes=None,
         datetimes=None,
         fee_rate=0.0026,
+        execution_model: ExecutionModel = None,
+        quote_asset='EUR',
     ) -> None:
+        # without execution model, fees are a flat fee_rate of trade values
         self.assets = pd.DataFrame(
             initial_volumes,
             columns=list(initial_volumes.keys()),
@@ -41,6 +69,12 @@ class VirtualPortfolio(object):
             index=datetimes,
         )
         self.fee_rate = fee_rate
+        self.execution_model = execution_model
+        self.quote_asset = quote_asset
+        # datetimes and notionals (portfolio quote asset) of the fills priced
+        # by the execution model, for the 30 days volume of its fee tiers
+        self.fill_datetimes = np.array([], dtype='datetime64[ns]')
+        self.fill_notionals = np.array([])
 
     def add_asset(
         self,
@@ -58,6 +92,20 @@ class VirtualPortfolio(object):
         # return(asset_code in self.assets['asset_code'].unique())
         return(asset_code in self.assets.columns)
 
+    def asset_column(
+        self,
+        asset_code,
+    ):
+        # column holding asset_code in any spelling known to the registry
+        # (ZEUR for EUR), None when the portfolio does not hold it
+        if self.asset_exists(asset_code):
+            return(asset_code)
+        registry = get_registry()
+        for column in self.assets.columns:
+            if registry.same_asset(column, asset_code):
+                return(column)
+        return(None)
+
     def get_asset_current_volume(
         self,
         asset_code,
@@ -97,8 +145,15 @@ class VirtualPortfolio(object):
         volume_sold: float = None,
         allow_short_sale: bool = False,
         datetime=None,
-        fees_ratio=0.0026,
+        fees_ratio: float = None,
+        quote_asset: str = None,
+        quote_rate=None,
     ):
+        # price is in asset_sold per asset_bought. Costs are computed on the
+        # quote_asset leg of the trade (portfolio quote asset by default)
+        # and converted into the portfolio quote asset with quote_rate, a
+        # constant or a Series of rates by datetime (see `quote_rates`).
+        # fees_ratio overrides the fee rate and the execution model.
         if not volume_sold:
             volume_sold = self.get_asset_current_volume(
                 asset_sold,
@@ -113,6 +168,52 @@ class VirtualPortfolio(object):
         ):
             raise RuntimeError('Short selling whereas flag has not been set.')
 
+        if not datetime:
+            raise ValueError('datetime unspecified for fee computation')
+        if quote_asset is None:
+            quote_asset = self.quote_asset
+        if asset_sold == quote_asset:
+            base_asset = asset_bought
+            base_volume = volume_sold / price
+            pair_price = price
+        elif asset_bought == quote_asset:
+            base_asset = asset_sold
+            base_volume = volume_sold
+            pair_price = 1 / price
+        else:
+            raise ValueError(
+                f'Quote asset {quote_asset} is not traded '
+                f'({asset_sold} -> {asset_bought})'
+            )
+        if quote_rate is None:
+            if not get_registry().same_asset(quote_asset, self.quote_asset):
+                raise ValueError(
+                    f'quote_rate needed to convert fees from {quote_asset}'
+                    f' into {self.quote_asset}'
+                )
+            quote_rate = 1.
+        quote_rate = _rates_at(quote_rate, [datetime])[0]
+
+        costs = None
+        if self.execution_model is not None and fees_ratio is None:
+            costs = self.execution_model.trade_costs(
+                datetime,
+                base_volume,
+                pair_price,
+                pair=get_registry().pair(
+                    base_asset,
+                    quote_asset,
+                    default=base_asset + quote_asset,
+                ),
+                quote_rate=quote_rate,
+                prior_fills=(self.fill_datetimes, self.fill_notionals),
+            )
+            if not costs['executed']:
+                raise ValueError(
+                    f'Volume {base_volume} of {base_asset} is below the '
+                    f'minimum order size'
+                )
+
         self.update_asset_volume(
             asset_sold,
             volume=-volume_sold,
@@ -127,21 +228,15 @@ class VirtualPortfolio(object):
             datetime=datetime,
         )
 
-        # should be updated to take care of case fee is applied to trade
-        # without asset being EUR
-        if asset_bought == 'EUR':
-            trade_value = volume_sold * price
-        elif asset_sold == 'EUR':
-            trade_value = volume_sold
+        if costs is not None:
+            self.fees.loc[datetime] += costs['total']
+            self.record_fills([datetime], [costs['notional']])
         else:
-            raise NotImplementedError(
-                "fee computation to be implemented."
+            self.update_fees(
+                trade_value=base_volume * pair_price * quote_rate,
+                overriden_fee_rate=fees_ratio,
+                datetime=datetime,
             )
-        self.update_fees(
-            trade_value=trade_value,
-            overriden_fee_rate=None,
-            datetime=datetime,
-        )
 
     def update_fees(
         self,
@@ -151,12 +246,13 @@ class VirtualPortfolio(object):
     ):
         if not datetime:
             raise ValueError('datetime unspecified for fee computation')
-        if overriden_fee_rate:
+        if overriden_fee_rate is not None:
             fee_rate = overriden_fee_rate
         else:
             fee_rate = self.fee_rate
         self.fees.loc[datetime] += trade_value * fee_rate
 
+    @profiled
     def pretty_trade(
         self,
         base_asset_code: str,
@@ -168,6 +264,7 @@ class VirtualPortfolio(object):
         trade_type: str = 'buy',
         datetime=None,
         verbose=0,
+        quote_rate=None,
     ) -> None:
         if market_price:
             raise NotImplementedError("Market price service to be integrated")
@@ -205,37 +302,194 @@ class VirtualPortfolio(object):
             volume_sold=volume_sold,
             allow_short_sale=allow_short_sale,
             datetime=datetime,
+            quote_asset=quote_asset_code,
+            quote_rate=quote_rate,
+        )
+
+    @profiled
+    def apply_trades(
+        self,
+        trades: pd.DataFrame,
+        prices: pd.DataFrame,
+        quote_asset: str = None,
+        quote_rate=None,
+        allow_short_sale: bool = False,
+        fees_ratio: float = None,
+    ) -> None:
+        # applies a whole trade schedule at once: `trades` holds the volume of
+        # each base asset (columns) bought, or sold when negative, at each
+        # datetime, `prices` their price in quote_asset. quote_rate is as in
+        # `trade`, a Series gives the rate of each bar.
+        if quote_asset is None:
+            quote_asset = self.quote_asset
+        if quote_rate is None:
+            if not get_registry().same_asset(quote_asset, self.quote_asset):
+                raise ValueError(
+                    f'quote_rate needed to convert fees from {quote_asset}'
+                    f' into {self.quote_asset}'
+                )
+            quote_rate = 1.
+        # the quote balance is booked in the spelling of the portfolio
+        quote_asset = self.asset_column(quote_asset) or quote_asset
+        missing = trades.index.difference(self.assets.index)
+        if len(missing):
+            raise ValueError(
+                f'{len(missing)} trade datetimes are not in the portfolio '
+                f'datetimes, first one: {missing[0]}'
+            )
+        trades = trades.reindex(index=self.assets.index).fillna(0.)
+        prices = prices.reindex(index=self.assets.index)[trades.columns]
+
+        fills = trades.stack()
+        fills = fills[fills != 0]
+        fill_datetimes = fills.index.get_level_values(0)
+        fill_assets = fills.index.get_level_values(1)
+        fill_prices = prices.stack().reindex(fills.index).to_numpy()
+        if np.isnan(fill_prices).any():
+            position = np.flatnonzero(np.isnan(fill_prices))[0]
+            raise ValueError(
+                f'No price of {fill_assets[position]} for the trade at '
+                f'{fill_datetimes[position]}'
+            )
+        fill_rates = _rates_at(quote_rate, fill_datetimes)
+        if self.execution_model is not None and fees_ratio is None:
+            registry = get_registry()
+            pairs = registry.pairs(
+                registry.asset_ids(trades.columns, default=-1),
+                registry.asset_id(quote_asset, default=-1),
+            )[trades.columns.get_indexer(fill_assets)]
+            if (pairs < 0).any():
+                pairs = (fill_assets + quote_asset).to_numpy()
+            costs = self.execution_model.costs(
+                fill_datetimes.to_numpy(),
+                fills.to_numpy(),
+                fill_prices,
+                pairs=pairs,
+                quote_rates=fill_rates,
+                prior_fills=(self.fill_datetimes, self.fill_notionals),
+            )
+            # as in `trade`, fills below the minimum order size are rejected
+            if not costs['executed'].all():
+                position = np.flatnonzero(~costs['executed'])[0]
+                raise ValueError(
+                    f'Volume {abs(fills.iloc[position])} of '
+                    f'{fill_assets[position]} at {fill_datetimes[position]}'
+                    f' is below the minimum order size'
+                )
+            fees = costs['total']
+            priced_notionals = costs['notional']
+        else:
+            priced_notionals = None
+            fees = (
+                (self.fee_rate if fees_ratio is None else fees_ratio)
+                * np.abs(fills.to_numpy() * fill_prices) * fill_rates
+            )
+
+        notionals = (trades * prices).fillna(0.)
+        assets = self.assets.copy()
+        for asset in list(trades.columns) + [quote_asset]:
+            if asset not in assets.columns:
+                assets[asset] = 0.
+        assets[trades.columns] += trades.cumsum()
+        assets[quote_asset] -= notionals.sum(axis=1).cumsum()
+        # rounding of the quote balance when selling everything
+        tolerance = 1e-9 * max(float(assets.abs().max().max()), 1.)
+        if not allow_short_sale and (assets < -tolerance).any().any():
+            raise RuntimeError('Short selling whereas flag has not been set.')
+        self.assets = assets
+        if fills.empty:
+            return
+        self.fees = self.fees.add(
+            pd.Series(fees, index=fill_datetimes).groupby(level=0).sum(),
+            fill_value=0.,
+        )
+        if priced_notionals is not None:
+            self.record_fills(fill_datetimes, priced_notionals)
+
+    def record_fills(
+        self,
+        datetimes,
+        notionals,
+    ):
+        # adds fills to the volume history passed to the execution model,
+        # kept sorted by datetime (UTC for timezone aware datetimes)
+        datetimes = pd.DatetimeIndex(datetimes)
+        if datetimes.tz is not None:
+            datetimes = datetimes.tz_convert(None)
+        datetimes = np.concatenate([self.fill_datetimes, datetimes.to_numpy()])
+        order = np.argsort(datetimes, kind='stable')
+        self.fill_datetimes = datetimes[order]
+        self.fill_notionals = np.concatenate([
+            self.fill_notionals,
+            np.asarray(notionals, dtype=float),
+        ])[order]
+
+    def quote_rates(
+        self,
+        prices_history,
+        quote_asset,
+    ):
+        # price of quote_asset in the portfolio quote asset at each bar of
+        # prices_history, from the column of their pair or of the inverse one
+        registry = get_registry()
+        if registry.same_asset(quote_asset, self.quote_asset):
+            return(pd.Series(1., index=prices_history.index))
+        positions = registry.column_positions(prices_history.columns)
+        for base, quote, power in [
+            (quote_asset, self.quote_asset, 1),
+            (self.quote_asset, quote_asset, -1),
+        ]:
+            pair_id = registry.pair(base, quote, default=-1)
+            if pair_id >= 0 and positions[pair_id] >= 0:
+                return(prices_history.iloc[:, positions[pair_id]] ** power)
+        raise RuntimeError(
+            f'No {quote_asset} price in {self.quote_asset} in prices history'
         )
 
     def __repr__(self):
         return(repr(self.assets))
 
+    @profiled
     def historic_valorisation(
         self,
         prices_history=None,
         quote_asset='EUR',
     ):
-
-        portfolio_values = pd.DataFrame(index=prices_history.index)
-
-        # check if all current assets have prices in quote asset
-        for asset in self.assets.columns:
-            if (
-                asset + quote_asset not in prices_history.columns and
-                asset != quote_asset
-            ):
+        # the price of each asset is the column of prices_history naming
+        # its pair with quote_asset, in any spelling known to the registry
+        # (e.g. BTCEUR, XBTEUR or XXBTZEUR for BTC), or asset + quote_asset.
+        # Assets spelling quote_asset differently (ZEUR for EUR) are cash.
+        registry = get_registry()
+        quote_id = registry.asset_id(quote_asset, default=-1)
+        asset_ids = registry.asset_ids(self.assets.columns, default=-1)
+        cash = (self.assets.columns == quote_asset) | (
+            (asset_ids == quote_id) & (quote_id >= 0)
+        )
+        # pair id -> column, looked up for the pair of each asset
+        pair_ids = registry.pairs(asset_ids, quote_id)
+        positions = np.where(
+            pair_ids >= 0,
+            registry.column_positions(prices_history.columns)[pair_ids],
+            -1,
+        )
+        for k in np.flatnonzero((positions < 0) & ~cash):
+            asset = self.assets.columns[k]
+            if asset + quote_asset not in prices_history:
                 raise RuntimeError(f"asset {asset} missing in prices history")
+            positions[k] = prices_history.columns.get_loc(asset + quote_asset)
 
+        assets = self.assets.reindex(prices_history.index)
         portfolio_values = pd.DataFrame(index=prices_history.index)
-        portfolio_values[quote_asset] = self.assets[quote_asset]
-        for asset in self.assets.columns:
-            if asset == quote_asset:
-                continue
-            portfolio_values[asset] = (
-                prices_history[asset + quote_asset] * self.assets[asset]
-            )
+        portfolio_values[quote_asset] = assets.loc[:, cash].sum(axis=1)
+        values = (
+            prices_history.to_numpy(dtype=np.float64)[:, positions[~cash]]
+            * assets.loc[:, ~cash].to_numpy()
+        )
+        for k, asset in enumerate(self.assets.columns[~cash]):
+            portfolio_values[asset] = values[:, k]
         return(portfolio_values)
 
+    @profiled
     def eval_performance(
         self,
         prices_history=None,
@@ -281,23 +535,57 @@ class CrossAverageStrategy(object):
         # profit_save_rate=0.,
         long_window=20,
         short_window=5,
+        base_asset=None,
+        quote_asset=None,
     ) -> None:
+        # base and quote assets default to the common names of the assets of
+        # trading_pair (BTC and EUR for BTCEUR, XBTEUR or XXBTZEUR); they are
+        # matched with the portfolio columns in any spelling on evaluation
         # self.profit_save_rate = profit_save_rate
         self.trading_pair = trading_pair
         self.long_window = long_window
         self.short_window = short_window
-
+        self.pair_id = None
+        if trading_pair is not None:
+            registry = get_registry()
+            self.pair_id = registry.pair_id(trading_pair, default=None)
+            if self.pair_id is not None:
+                base_id, quote_id = registry.pair_assets(self.pair_id)
+                base_asset = base_asset or registry.names[base_id]
+                quote_asset = quote_asset or registry.names[quote_id]
+        self.base_asset = base_asset or 'BTC'
+        self.quote_asset = quote_asset or 'EUR'
+
+    def pair_column(self, price_history):
+        # column of price_history holding the traded pair, which may be
+        # spelled differently from trading_pair (XBTEUR for BTCEUR)
+        if (
+            self.trading_pair in price_history.columns
+            or self.pair_id is None
+        ):
+            return(self.trading_pair)
+        position = get_registry().column_positions(
+            price_history.columns,
+        )[self.pair_id]
+        if position < 0:
+            return(self.trading_pair)
+        return(price_history.columns[position])
+
+    @profiled
     def generate_signals(
         self,
         data,
         create_viz=False,
+        viz_path=None,
     ) -> List[Signal]:
         # here, data is a timeseries with asset price.
-        price_series = data.loc[:, self.trading_pair]
+        price_series = data.loc[:, self.pair_column(data)]
         short_mv = price_series.rolling(self.short_window).mean(center=False)
         long_mv = price_series.rolling(self.long_window).mean(center=False)
-        buys = (short_mv > long_mv) & ~(short_mv > long_mv).shift(1).iloc[1:]
-        sells = ~(short_mv > long_mv) & (short_mv > long_mv).shift(1).iloc[1:]
+        # ties within rounding are not above, as in the vectorized kernels
+        above = is_above(short_mv, long_mv)
+        buys = above & ~above.shift(1).iloc[1:]
+        sells = ~above & above.shift(1).iloc[1:]
         idxs = buys | sells
         signals = []
         for datetime in idxs.loc[idxs].index:
@@ -309,72 +597,101 @@ class CrossAverageStrategy(object):
                 raise RuntimeError('Unexpected buy / sell type')
             signals.append(
                 Signal(
-                    base_asset='BTC',
-                    quote_asset='EUR',
+                    base_asset=self.base_asset,
+                    quote_asset=self.quote_asset,
                     signal_type=signal_type,
                     datetime=datetime,
                     volume=None,
+                    pair_id=self.pair_id,
                 )
             )
 
         if create_viz:
-            fig, ax = plt.subplots(figsize=(20, 20))
-            ax.plot(price_series)
-            ax.plot(short_mv)
-            ax.plot(long_mv)
-            ax.scatter(
-                buys[buys].index,
-                price_series[buys[buys].index],
-                marker="^",
-                s=200,
-                color='green',
-            )
-            ax.scatter(
-                sells[sells].index,
-                price_series[sells[sells].index],
-                marker="v",
-                s=200,
-                color='red',
+            plot_signals(
+                price_series,
+                short_mv,
+                long_mv,
+                buys,
+                sells,
+                save_path=viz_path,
             )
 
         return(signals)
 
+    def target_weights(
+        self,
+        price_history=None,
+        sizer=None,
+    ):
+        # portfolio weight of the base asset at each bar of price_history:
+        # the base asset is held from the first buy signal until the next
+        # sell, sized by `sizer` (the whole portfolio by default). Held bars
+        # compare the means as `generate_signals` does (`is_above`), so that
+        # ties of flat prices open or close no position.
+        if sizer is None:
+            sizer = FixedFraction()
+        prices = price_history.loc[
+            :, [self.pair_column(price_history)]
+        ].to_numpy(dtype=np.float64)
+        duration = price_history.index.max() - price_history.index.min()
+        return(
+            sizer.target_weights(
+                held_state(prices, self.short_window, self.long_window),
+                prices,
+                bar_seconds=(
+                    duration.total_seconds() / max(len(prices) - 1, 1)
+                ),
+            )
+        )
+
+    @profiled
     def evaluate(
         self,
         price_history=None,
         initial_portfolio: VirtualPortfolio = None,
         create_viz=False,
+        sizer=None,
         # initial_free_value=None,
     ) -> None:
+        # the portfolio (quote and base asset balances at the start of
+        # price_history) is allocated according to `target_weights` from the
+        # first signal on, and the resulting trades are applied to the
+        # portfolio in bulk. Assets are booked in the spelling used by the
+        # portfolio (ZEUR, XXBT...), the quote asset must be held.
         portfolio = initial_portfolio
-        # price_history = price_history[self.trading_pair]
-        # initial_portfolio_value = portfolio.eval_value(
-        #     prices = pd.Series({
-        #         'EUR': 1.0,
-        #         'BTC': 100.,
-        #     }),
-        # )
-        # free_value = initial_free_value
-        signals = self.generate_signals(
-            price_history,
-            create_viz=create_viz,
-        )
-
-        if signals[0].signal_type == "sell":
-            signals = signals[1:]
-        for signal in signals:
-            # print(price_history)
-            price = price_history.loc[signal.datetime, self.trading_pair]
-            # print(portfolio)
-            portfolio.pretty_trade(
-                signal.base_asset,
-                signal.quote_asset,
-                price=price,
-                volume=None,
-                allow_short_sale=False,
-                trade_type=signal.signal_type,
-                datetime=signal.datetime,
+        quote_asset = portfolio.asset_column(self.quote_asset)
+        if quote_asset is None:
+            raise RuntimeError(
+                f'Quote asset {self.quote_asset} is not in the portfolio'
             )
+        base_asset = portfolio.asset_column(self.base_asset)
+        if create_viz:
+            self.generate_signals(
+                price_history,
+                create_viz=create_viz,
+            )
+        prices = price_history.loc[:, [self.pair_column(price_history)]]
+        start = price_history.index.min()
+        units, cash, trades = rebalance(
+            prices.to_numpy(dtype=np.float64),
+            self.target_weights(price_history, sizer=sizer),
+            initial_value=portfolio.assets.loc[start, quote_asset],
+            initial_units=[
+                0. if base_asset is None
+                else portfolio.assets.loc[start, base_asset]
+            ],
+        )
+        base_asset = base_asset or self.base_asset
+        portfolio.apply_trades(
+            pd.DataFrame(
+                trades,
+                index=price_history.index,
+                columns=[base_asset],
+            ),
+            prices.set_axis([base_asset], axis=1),
+            quote_asset=quote_asset,
+            quote_rate=portfolio.quote_rates(price_history, quote_asset),
+        )
         return(
             portfolio.eval_performance(
                 prices_history=price_history,
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+# Downsampling of long series for display.
+#
+# A plot is at most a few thousand pixels wide, so drawing every bar of a
+# year of minute prices only costs time and memory. Series are reduced to a
+# number of points close to the pixel width, either keeping the min and max
+# of each pixel bucket (exact envelope, 2 points per bucket) or with Largest
+# Triangle Three Buckets (visually faithful, 1 point per bucket). Indices in
+# `keep` (e.g. buy and sell bars) are always part of the result.
+
+methods = ('minmax', 'lttb')
+
+
+def minmax_indices(y, n_buckets):
+    # index of the min and max of each of `n_buckets` consecutive buckets
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return(np.arange(n))
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    # buckets full of NaN give their first index, which stays a gap
+    minimums = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    maximums = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    indices = np.concatenate([offsets + minimums, offsets + maximums, [n - 1]])
+    return(np.unique(np.minimum(indices, n - 1)))
+
+
+def lttb_indices(x, y, n_out):
+    # Largest Triangle Three Buckets (Steinarsson, 2013): keeps, in each
+    # bucket, the point forming the largest triangle with the point kept in
+    # the previous bucket and the average of the next one
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return(np.arange(n))
+    valid = ~np.isnan(y)
+    if not valid.all():
+        # missing values are interpolated for the triangle areas
+        y = np.where(valid, y, np.interp(x, x[valid], y[valid]))
+    every = (n - 2) / (n_out - 2)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for k in range(n_out - 2):
+        start = int(k * every) + 1
+        stop = int((k + 1) * every) + 1
+        next_stop = min(int((k + 2) * every) + 1, n)
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        indices[k + 1] = previous
+    return(np.unique(indices))
+
+
+def downsample_indices(
+    y,
+    n_out,
+    x=None,
+    method='minmax',
+    keep=None,
+):
+    # sorted indices of the points to draw, about `n_out` of them plus `keep`
+    if x is None:
+        x = np.arange(len(y))
+    if method == 'minmax':
+        indices = minmax_indices(y, max(n_out // 2, 1))
+    elif method == 'lttb':
+        indices = lttb_indices(x, y, n_out)
+    else:
+        raise ValueError(f'Unexpected method: {method}')
+    if keep is not None and len(keep):
+        indices = np.union1d(indices, np.asarray(keep, dtype=np.int64))
+    return(indices)
+
+
+def _numeric(index):
+    values = np.asarray(index)
+    if values.dtype.kind == 'M':
+        return(values.astype('datetime64[ns]').astype(np.int64))
+    return(values.astype(np.float64))
+
+
+def downsample_series(
+    series,
+    n_out,
+    method='minmax',
+    keep=None,
+):
+    # pandas Series version, `keep` holds index labels to always keep
+    positions = None
+    if keep is not None and len(keep):
+        positions = series.index.get_indexer(keep)
+        positions = positions[positions >= 0]
+    return(
+        series.iloc[
+            downsample_indices(
+                series.to_numpy(dtype=np.float64),
+                n_out,
+                x=_numeric(series.index),
+                method=method,
+                keep=positions,
+            )
+        ]
+    )
@@ -0,0 +1,160 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from services.viz.downsample import downsample_series
+
+
+# Interactive signal plots with holoviews / bokeh.
+#
+# Plots are DynamicMaps bound to the x range of the bokeh figure: each zoom
+# or pan redraws the visible range only, downsampled to about one point per
+# pixel (or re-aggregated from an OHLCPyramid), while every buy and sell
+# marker of the range is drawn. With `headless=True` a static overlay of the
+# whole range is returned instead, which can be written to an HTML report
+# with `save_report` without a running bokeh server or notebook.
+#
+# holoviews is imported when a plot is built, never at module import.
+
+
+def _holoviews():
+    import holoviews as hv
+    if hv.Store.current_backend != 'bokeh' or not hv.Store.renderers:
+        hv.extension('bokeh', logo=False)
+    return(hv)
+
+
+def _range_bounds(x_range):
+    if x_range is None or None in x_range:
+        return(None, None)
+    return(tuple(pd.Timestamp(x).to_pydatetime() for x in x_range))
+
+
+def _markers(hv, prices, signals, marker, color, start, end):
+    # markers at the price of the bar of each signal, or of the last bar
+    # before it when prices are aggregated
+    if signals is None:
+        return(hv.Scatter([], 'datetime', 'price'))
+    if isinstance(signals, pd.Series):
+        datetimes = signals[signals.astype(bool)].index
+    else:
+        datetimes = pd.DatetimeIndex(signals)
+    if start is not None:
+        datetimes = datetimes[(datetimes >= start) & (datetimes <= end)]
+    return(
+        hv.Scatter(
+            (datetimes, prices.reindex(datetimes, method='ffill').to_numpy()),
+            'datetime',
+            'price',
+        ).opts(marker=marker, color=color, size=12)
+    )
+
+
+def signals_plot(
+    price_series,
+    short_mv=None,
+    long_mv=None,
+    buys=None,
+    sells=None,
+    width=1200,
+    height=500,
+    method='minmax',
+    headless=False,
+):
+    # price and moving averages with buy / sell markers. buys and sells are
+    # boolean Series (as built by `generate_signals`) or datetime indexes
+    hv = _holoviews()
+    lines = [
+        (name, series) for name, series in (
+            ('price', price_series),
+            ('short_mv', short_mv),
+            ('long_mv', long_mv),
+        ) if series is not None
+    ]
+
+    def view(x_range=None):
+        start, end = _range_bounds(x_range)
+        curves = []
+        for name, series in lines:
+            visible = series.loc[start:end]
+            visible = downsample_series(visible, width, method=method)
+            curves.append(
+                hv.Curve(
+                    (visible.index, visible.to_numpy()),
+                    'datetime',
+                    'price',
+                    label=name,
+                )
+            )
+        return(
+            hv.Overlay(
+                curves + [
+                    _markers(
+                        hv, price_series, buys, 'triangle', 'green', start, end
+                    ),
+                    _markers(
+                        hv,
+                        price_series,
+                        sells,
+                        'inverted_triangle',
+                        'red',
+                        start,
+                        end,
+                    ),
+                ]
+            ).opts(width=width, height=height)
+        )
+
+    if headless:
+        return(view())
+    return(hv.DynamicMap(view, streams=[hv.streams.RangeX()]))
+
+
+def pyramid_plot(
+    pyramid,
+    buys=None,
+    sells=None,
+    width=1200,
+    height=500,
+    headless=False,
+):
+    # close price with the high / low band of an OHLCPyramid, re-aggregated
+    # from the level matching the visible range at each zoom
+    hv = _holoviews()
+
+    def view(x_range=None):
+        start, end = _range_bounds(x_range)
+        bars = pyramid.select(
+            None if start is None else dt.datetime.timestamp(start),
+            None if end is None else dt.datetime.timestamp(end),
+            n_bars=width,
+        )
+        datetimes = pd.DatetimeIndex(
+            [dt.datetime.fromtimestamp(y) for y in bars.timestamps]
+        )
+        closes = pd.Series(bars.close, index=datetimes, dtype=np.float64)
+        return(
+            hv.Overlay([
+                hv.Area(
+                    (datetimes, bars.low, bars.high),
+                    'datetime',
+                    ['low', 'high'],
+                ).opts(alpha=0.3, line_alpha=0),
+                hv.Curve((datetimes, closes.to_numpy()), 'datetime', 'price'),
+                _markers(hv, closes, buys, 'triangle', 'green', start, end),
+                _markers(
+                    hv, closes, sells, 'inverted_triangle', 'red', start, end
+                ),
+            ]).opts(width=width, height=height)
+        )
+
+    if headless:
+        return(view())
+    return(hv.DynamicMap(view, streams=[hv.streams.RangeX()]))
+
+
+def save_report(plot, path):
+    # writes a static plot (headless=True) to an HTML file
+    hv = _holoviews()
+    hv.save(plot, str(path), backend='bokeh')
+    return(path)
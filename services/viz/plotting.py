@@ -0,0 +1,48 @@
+from services.viz.downsample import downsample_series
+
+
+# matplotlib is only imported when a figure is actually requested, so that
+# the headless core (portfolio, signals, data loading) never pays for it.
+# Lines are downsampled to `max_points` (min / max per bucket), buy and sell
+# bars are always kept. With `save_path` the figure is rendered off screen
+# without pyplot and written to the file.
+
+
+def plot_signals(
+    price_series,
+    short_mv,
+    long_mv,
+    buys,
+    sells,
+    figsize=(20, 20),
+    max_points=4000,
+    save_path=None,
+):
+    if save_path is not None:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+        ax = fig.subplots()
+    else:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=figsize)
+
+    markers = buys[buys].index.union(sells[sells].index)
+    for series in (price_series, short_mv, long_mv):
+        ax.plot(downsample_series(series, max_points, keep=markers))
+    ax.scatter(
+        buys[buys].index,
+        price_series[buys[buys].index],
+        marker="^",
+        s=200,
+        color='green',
+    )
+    ax.scatter(
+        sells[sells].index,
+        price_series[sells[sells].index],
+        marker="v",
+        s=200,
+        color='red',
+    )
+    if save_path is not None:
+        fig.savefig(save_path)
+    return(fig, ax)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from services.hist_data.compact import CompactOHLC, fields
+
+
+# Multi resolution OHLC pyramid.
+#
+# Level 0 is the original CompactOHLC, each following level aggregates
+# `factor` bars of the previous one (first open, max high, min low, last
+# close, summed volumes and trade counts). A plot of any time range then
+# reads the coarsest level that still has about one bar per pixel, so
+# zooming out on a year of minute bars never touches the minute level.
+
+
+def aggregate(ohlc, factor):
+    # CompactOHLC with bars of `factor` times the frequency, missing bars of
+    # `ohlc` are filled with its fill policy before aggregation
+    starts = np.arange(0, ohlc.n_bars, factor)
+    if len(starts) == 0:
+        return(CompactOHLC.empty(ohlc.start, ohlc.freq * factor, 0))
+    ends = np.append(starts[1:], ohlc.n_bars) - 1
+    columns = {field: ohlc.column(field) for field in fields}
+    valid = np.logical_or.reduceat(ohlc.valid, starts)
+    aggregated = {
+        'open': columns['open'][starts],
+        'high': np.fmax.reduceat(columns['high'], starts),
+        'low': np.fmin.reduceat(columns['low'], starts),
+        'close': columns['close'][ends],
+        'volume': np.add.reduceat(columns['volume'], starts),
+        'trade_count': np.add.reduceat(columns['trade_count'], starts),
+    }
+    return(
+        CompactOHLC(
+            start=ohlc.start,
+            freq=ohlc.freq * factor,
+            columns={
+                field: aggregated[field].astype(columns[field].dtype)
+                for field in fields
+            },
+            valid_bits=np.packbits(valid, bitorder='little'),
+            n_bars=len(starts),
+            fill_policy=ohlc.fill_policy,
+        )
+    )
+
+
+class OHLCPyramid(object):
+    # OHLC bars of one pair at increasingly coarse resolutions
+    def __init__(
+        self,
+        ohlc,
+        factor=4,
+        min_bars=256,
+    ) -> None:
+        self.factor = factor
+        self.levels = [ohlc]
+        while self.levels[-1].n_bars > min_bars:
+            self.levels.append(aggregate(self.levels[-1], factor))
+
+    @property
+    def start(self):
+        return(self.levels[0].start)
+
+    @property
+    def end(self):
+        return(self.levels[0].end)
+
+    def select(self, start=None, end=None, n_bars=1000):
+        # bars of [start, end[ (epoch seconds) from the coarsest level having
+        # at least `n_bars` bars on the range
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        selected = self.levels[0]
+        for level in self.levels:
+            if (end - start) / level.freq < n_bars:
+                break
+            selected = level
+        return(selected.slice(start, end))